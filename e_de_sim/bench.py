@@ -0,0 +1,248 @@
+"""
+Throughput benchmarks of the e-dE simulation pipeline.
+
+Cases run on the bundled data tables:
+ - srim_parse: parsing of bundled SRIM files & a large synthetic one
+ - store_cold / store_warm: StoppingPowersStore start-up with an empty and
+   with a filled binary cache
+ - kinematics_*: batch sampling of reaction kinematics
+ - e_loss_*: e-loss of each detector type
+ - hist_fill: E vs dE histogram filling
+ - reco_e_de: reconstruction of incident energies & species from E & dE
+ - run: full EspriEdESim.run() at several amounts of events per reaction,
+   rates are in events of all reactions per second
+
+Results are written as JSON, results of two commits can be compared with
+--compare.
+
+Usage: python bench.py [-o results.json] [--compare old.json]
+                       [--max-events N] [--repeat N]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from timeit import default_timer as timer
+
+import numpy as np
+
+from eloss.ede import *
+from eloss.detectors import *
+from eloss.histogram import Hist2D
+from eloss.response import ResponseTable, WedgeResponseMap
+from eloss.reco import EnergyReconstructor
+from bench_srim import make_synthetic_srim_file
+import sim
+
+
+DEFAULT_RUN_EVENTS = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+# amount of events in benchmarks of single pipeline stages
+DEFAULT_BATCH_SIZE = 10 ** 6
+SYNTHETIC_SRIM_ROWS = 50000
+DEFAULT_REPEAT = 3
+BENCH_SEED = 12345
+# angular region and reactions of the full simulation benchmark
+RUN_ANGULAR_REGION = (55., 70.)
+
+
+def best_time(func, repeat=DEFAULT_REPEAT):
+    """Returns the best wall time of func() out of repeat calls."""
+    times = []
+    for i in range(repeat):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return min(times)
+
+
+def result(name, n, seconds, unit='events'):
+    return {'name': name, 'n': n, 'unit': unit, 'seconds': seconds,
+            'rate': n / seconds if seconds > 0 else float('inf')}
+
+
+def bench_srim(repeat):
+    results = []
+    store = StoppingPowersStore()
+    files = sorted(store.data_files().values())
+    n_rows = sum(len(read_srim_stopping_power_csv(f)) for f in files)
+    t = best_time(lambda: [read_srim_stopping_power_csv(f) for f in files],
+                  repeat)
+    results.append(result('srim_parse_bundled', n_rows, t, 'rows'))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'Hydrogen in Synthetic.txt')
+        make_synthetic_srim_file(path, SYNTHETIC_SRIM_ROWS)
+        t = best_time(lambda: read_srim_stopping_power_csv(path), repeat)
+        results.append(result('srim_parse_synthetic', SYNTHETIC_SRIM_ROWS,
+                              t, 'rows'))
+
+        # store start-up: cold cache parses SRIM files & writes the cache,
+        # warm one memory-maps cached tables
+        cache_dir = os.path.join(tmp_dir, 'cache')
+
+        def start_store():
+            StoppingPowersStore(cache_dir=cache_dir).load_data()
+
+        start = timer()
+        start_store()
+        results.append(result('store_cold', len(files), timer() - start,
+                              'tables'))
+        results.append(result('store_warm', len(files),
+                              best_time(start_store, repeat), 'tables'))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_kinematics(n, repeat):
+    rng = np.random.default_rng(BENCH_SEED)
+    angles = rng.uniform(RUN_ANGULAR_REGION[0], RUN_ANGULAR_REGION[1], n)
+    results = []
+    for name, kin in [('kinematics_table', sim.SCATT_D_KIN),
+                      ('kinematics_random',
+                       sim.RandomProtonKinematics([10., 100.]))]:
+        kin.sample(angles[:10], rng)
+        t = best_time(lambda: kin.sample(angles, rng), repeat)
+        results.append(result(name, n, t))
+    return results
+
+
+def bench_e_loss(n, repeat):
+    rng = np.random.default_rng(BENCH_SEED)
+    angles = rng.uniform(RUN_ANGULAR_REGION[0], RUN_ANGULAR_REGION[1], n)
+    e = rng.uniform(20., 200., n)
+    esim = sim.EspriEdESim(RUN_ANGULAR_REGION)
+    detectors = [
+        ('e_loss_wedge', esim.espri_e_degrader),
+        ('e_loss_plastic', esim.espri_plastic),
+        ('e_loss_nai', esim.espri_nai),
+        ('e_loss_absorber', Absorber(BRASS_ID, 10.)),
+        ('e_loss_response_table', ResponseTable(esim.espri_nai)),
+        ('e_loss_wedge_response_map',
+         WedgeResponseMap(esim.espri_e_degrader)),
+    ]
+    results = []
+    for name, detector in detectors:
+        # first call resolves stopping powers and builds tables
+        detector.layer_e_loss(PROTON_ID, e[:10], angles[:10], rng)
+        t = best_time(
+            lambda: detector.layer_e_loss(PROTON_ID, e, angles, rng), repeat)
+        results.append(result(name, n, t))
+    return results
+
+
+def bench_hist(n, repeat):
+    rng = np.random.default_rng(BENCH_SEED)
+    e = rng.uniform(0., 200., n)
+    de = rng.uniform(0., 37., n)
+    hist = Hist2D()
+    return [result('hist_fill', n, best_time(lambda: hist.fill(e, de),
+                                             repeat))]
+
+
+def bench_reco(n, repeat):
+    rng = np.random.default_rng(BENCH_SEED)
+    e = rng.uniform(0., 200., n)
+    de = rng.uniform(0., 37., n)
+    esim = sim.EspriEdESim(RUN_ANGULAR_REGION)
+    reco = EnergyReconstructor(esim.espri_plastic, esim.espri_nai,
+                               [PROTON_ID, DEUTERON_ID, TRITIUM_ID])
+    return [result('reco_e_de', n,
+                   best_time(lambda: reco.reconstruct(e, de), repeat))]
+
+
+def bench_run(run_events, repeat):
+    esim = sim.EspriEdESim(RUN_ANGULAR_REGION,
+                           [sim.SCATT_D_KIN, sim.RECOIL_P_KIN])
+    esim.load_stopping_powers()
+    n_reactions = len(esim.reaction_kinematics_data)
+    results = []
+    for n in run_events:
+        rng = np.random.default_rng(BENCH_SEED)
+
+        def run():
+            esim.results = []
+            esim.run(n, rng, hist=Hist2D())
+
+        # large runs are repeated once only
+        t = best_time(run, repeat if n <= DEFAULT_BATCH_SIZE else 1)
+        esim.results = []
+        results.append(result('run', n * n_reactions, t))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(run_events=DEFAULT_RUN_EVENTS,
+                   batch_size=DEFAULT_BATCH_SIZE, repeat=DEFAULT_REPEAT):
+    """Runs all benchmarks, returns dict with environment & results."""
+    results = []
+    results.extend(bench_srim(repeat))
+    results.extend(bench_kinematics(batch_size, repeat))
+    results.extend(bench_e_loss(batch_size, repeat))
+    results.extend(bench_hist(batch_size, repeat))
+    results.extend(bench_reco(batch_size, repeat))
+    results.extend(bench_run(run_events, repeat))
+    return {'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'results': results}
+
+
+def compare(old, new):
+    """Returns lines with rates of new results relative to old ones."""
+    old_rates = dict(((r['name'], r['n']), r['rate'])
+                     for r in old['results'])
+    lines = ['{:24} {:>10} {:>14} {:>14} {:>7}'.format(
+        'name', 'n', 'old rate', 'new rate', 'ratio')]
+    for r in new['results']:
+        old_rate = old_rates.get((r['name'], r['n']))
+        lines.append('{:24} {:>10} {:>14} {:>14.4g} {:>7}'.format(
+            r['name'], r['n'],
+            '{:.4g}'.format(old_rate) if old_rate else '-', r['rate'],
+            '{:.2f}'.format(r['rate'] / old_rate) if old_rate else '-'))
+    return lines
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help='JSON file to write results into')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--max-events', type=int,
+                        default=DEFAULT_RUN_EVENTS[-1],
+                        help='max amount of events per reaction of runs')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args(argv)
+
+    run_events = [n for n in DEFAULT_RUN_EVENTS if n <= args.max_events]
+    bench = run_benchmarks(run_events, min(DEFAULT_BATCH_SIZE,
+                                           args.max_events), args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(bench, f, indent=1)
+    for r in bench['results']:
+        print('{:24} {:>10} {:>10.4f} s {:>14.4g} {}/s'.format(
+            r['name'], r['n'], r['seconds'], r['rate'], r['unit']))
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), bench)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,129 @@
+"""
+Benchmark of SRIM stopping power parser on synthetic large SRIM outputs.
+
+Synthetic files reuse header & footer of a bundled SRIM table and have
+data blocks of a given amount of rows with mixed energy & range units.
+Parser throughput is compared to the old row-by-row parser, ranges of
+rows parsed by both are checked to agree.
+
+Usage: python bench_srim.py [rows ...]
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from eloss.ede import read_srim_stopping_power_csv, \
+    DEFAULT_STOPPING_POWERS_DATA_DIR
+
+
+TEMPLATE_SRIM_FILE = os.path.join(DEFAULT_STOPPING_POWERS_DATA_DIR,
+                                  'Hydrogen in NaI.txt')
+DEFAULT_ROWS = [100, 1000, 10000, 50000]
+# old parser is slow, do not run it on larger files
+MAX_LEGACY_ROWS = 10000
+
+
+def make_synthetic_srim_file(path, n_rows, template=TEMPLATE_SRIM_FILE):
+    """Writes SRIM file with n_rows of data into path."""
+    with open(template) as f:
+        lines = f.readlines()
+    header_end = [i for i, l in enumerate(lines)
+                  if re.match(r'^\s*-+(\s+-+){5,}\s*$', l)][0] + 1
+    footer_start = [i for i, l in enumerate(lines[header_end:])
+                    if re.match(r'^-+\s*$', l)][0] + header_end
+
+    e = np.logspace(-2, 3, n_rows)
+    rng = e * 1.2
+    rows = []
+    for e_val, r_val in zip(e, rng):
+        if e_val < 1.:
+            e_str = '{:7.2f} keV'.format(e_val * 1e3)
+        else:
+            e_str = '{:7.2f} MeV'.format(e_val)
+        if r_val < 1.:
+            r_str = '{:7.2f} um'.format(r_val * 1e3)
+        elif r_val < 1e3:
+            r_str = '{:7.2f} mm'.format(r_val)
+        else:
+            r_str = '{:7.2f} m '.format(r_val * 1e-3)
+        rows.append(' {}   {:.3E}  {:.3E}  {}    1.37 um     2.15 um\n'
+                    .format(e_str, 30. / (1. + e_val), 3e-2 / (1. + e_val),
+                            r_str))
+    with open(path, 'w') as f:
+        f.writelines(lines[:header_end])
+        f.writelines(rows)
+        f.writelines(lines[footer_start:])
+
+
+def read_srim_legacy(input_file):
+    """
+    Helper to read stopping power data from SRIM csv format.
+
+    Row-by-row parser of eloss.ede as it was before the vectorized one,
+    kept verbatim for comparison. It skips fixed amounts of header &
+    footer lines (and so the first data row of bundled files) and scales
+    stopping powers of keV rows by 1e-3.
+    """
+    df = pd.read_csv(input_file, sep=r"\s+", skiprows=25, skipfooter=13,
+                     header=None, usecols=[0, 1, 2, 3, 4, 5], engine='python')
+    df.columns = ['e', 'e_units', 'elec_de', 'nuc_de', 'range', 'range_units']
+
+    # normalize units, all to MeV & mm
+    df_rows = []
+    for index, row in df.iterrows():
+        if row['e_units'] == 'keV':
+            row['e'] *= 1e-3
+            row['elec_de'] *= 1e-3
+            row['nuc_de'] *= 1e-3
+        if row['range_units'] == 'um':
+            row['range'] *= 1e-3
+        elif row['range_units'] == 'm':
+            row['range'] *= 1e3
+        df_rows.append(row)
+    df_norm = pd.DataFrame(df_rows, columns=df.columns)
+    del df_norm['e_units']
+    del df_norm['range_units']
+    df_norm['tot_de'] = df_norm['elec_de'] + df_norm['nuc_de']
+    return df_norm.sort_values('e').reset_index(drop=True)
+
+
+def time_call(func, *args):
+    start = time.time()
+    res = func(*args)
+    return time.time() - start, res
+
+
+def run(rows_list=DEFAULT_ROWS):
+    """Returns a table of timings for each amount of rows."""
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        for n_rows in rows_list:
+            path = os.path.join(tmp_dir, 'Hydrogen in Synthetic.txt')
+            make_synthetic_srim_file(path, n_rows)
+            t, df = time_call(read_srim_stopping_power_csv, path)
+            assert len(df) == n_rows
+            t_legacy = np.nan
+            if n_rows <= MAX_LEGACY_ROWS:
+                t_legacy, df_legacy = time_call(read_srim_legacy, path)
+                # the old parser skips the first data row
+                assert len(df_legacy) == n_rows - 1
+                assert np.allclose(np.sort(df['range'].values)[1:],
+                                   np.sort(df_legacy['range'].values))
+            results.append((n_rows, t, n_rows / t, t_legacy, t_legacy / t))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return pd.DataFrame(results, columns=['rows', 'time', 'rows_per_sec',
+                                          'legacy_time', 'speedup'])
+
+
+if __name__ == '__main__':
+    rows_list = [int(a) for a in sys.argv[1:]] or DEFAULT_ROWS
+    print(run(rows_list).to_string(index=False))
@@ -0,0 +1,79 @@
+"""
+Checkpoints of sharded simulation runs.
+
+A checkpoint is one .npz file with the state accumulated by a run after
+its first shards: run parameters, seed, index of the next shard, amounts
+of events & store chunks per reaction and histogram counts. Shards get
+generators spawned from the run seed, so seed plus the next shard index
+is the whole random state of the run. Files are replaced atomically, a
+run killed while writing one leaves the previous checkpoint intact.
+"""
+
+import os
+import json
+import tempfile
+
+import numpy as np
+
+from .resultstore import _to_json
+
+
+class Checkpoint(object):
+    """State of a sharded run after its first next_shard shards."""
+
+    def __init__(self, params, seed, next_shard=0, events=None,
+                 store_chunks=None, hist_counts=None, hist_entries=0):
+        """
+        param: params - dict of run parameters, a run is resumed only with
+               the same ones
+        param: seed - entropy of the run SeedSequence
+        param: next_shard - index of the first shard not yet done
+        param: events - dict reaction name -> amount of simulated events
+        param: store_chunks - dict reaction name -> amount of chunks
+               written to the result store, None without a store
+        param: hist_counts, hist_entries - accumulated histogram, counts
+               are None without a histogram
+        """
+        self.params = _to_json(params)
+        self.seed = seed
+        self.next_shard = next_shard
+        self.events = dict(events or {})
+        self.store_chunks = store_chunks
+        self.hist_counts = hist_counts
+        self.hist_entries = hist_entries
+
+    def save(self, path):
+        """Writes checkpoint file atomically."""
+        meta = {'params': self.params, 'seed': str(self.seed),
+                'next_shard': self.next_shard, 'events': self.events,
+                'store_chunks': self.store_chunks,
+                'hist_entries': self.hist_entries}
+        arrays = {'meta': np.array(json.dumps(meta, sort_keys=True))}
+        if self.hist_counts is not None:
+            arrays['hist_counts'] = self.hist_counts
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads checkpoint written by save()."""
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            hist_counts = data['hist_counts'] \
+                if 'hist_counts' in data.files else None
+        return cls(meta['params'], int(meta['seed']), meta['next_shard'],
+                   meta['events'], meta['store_chunks'], hist_counts,
+                   meta['hist_entries'])
+
+    def check_params(self, params):
+        """Raises ValueError if a run with params cannot resume from this
+        checkpoint."""
+        params = _to_json(params)
+        if params != self.params:
+            changed = sorted(k for k in set(params) | set(self.params)
+                             if params.get(k) != self.params.get(k))
+            raise ValueError('Run parameters differ from the checkpoint '
+                             'ones: {}'.format(', '.join(changed)))
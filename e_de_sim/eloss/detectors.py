@@ -1,11 +1,101 @@
-import math
+from collections import OrderedDict
+
 import numpy as np
-from ede import Detector
+from .ede import Detector, MATERIAL_PROPERTIES, PARTICLE_CHARGES, \
+    PARTICLE_MASSES
+from . import timing
 
 
 # Detector definitions
 
 
+class Absorber(Detector):
+    """Generic layer of material, e.g. an extra layer of a DetectorStack."""
+
+    def __init__(self, material_id, thickness, resolution_sigma=0.):
+        """
+        param: material_id - name of the material from which it is made of
+        param: thickness - thickness in mm or a function returning
+               thicknesses for an array of scattering angles
+        param: resolution_sigma - resolution, percents from e-loss
+        """
+        super(Absorber, self).__init__(material_id)
+        self.thickness = thickness
+        self.resolution_sigma = resolution_sigma
+
+    def thickness_for(self, angles):
+        if callable(self.thickness):
+            return self.thickness(angles)
+        return self.thickness
+
+    def e_loss(self, particle_id, e, angles=None, rng=None):
+        """
+        Computes e-loss inside this layer for a given particle type.
+
+        param: e - Energy of the incident particle, scalar or array
+        param particle_id - Name of the particle
+        param: angles - Scattering angles in deg., used only when
+               thickness is a function of angle
+        param: rng - np.random.Generator used for resolution smearing
+        """
+        stop_pow = self._find_stop_pow(particle_id)
+        e_loss = stop_pow.e_loss(particle_id, e, self.thickness_for(angles),
+                                 straggling=self.straggling, rng=rng)
+        if self.resolution_sigma:
+            e_loss = e_loss + self.get_resolution_error(e_loss, rng)
+        return e_loss
+
+    def layer_e_loss(self, particle_id, e, angles=None, rng=None):
+        return self.e_loss(particle_id, e, angles, rng)
+
+
+class DetectorStack(object):
+    """
+    Ordered layers of detectors which particles pass one after another.
+    """
+
+    def __init__(self, layers=()):
+        """
+        param: layers - list of (name, detector) in order of passage
+        """
+        self.layers = list(layers)
+
+    def add_layer(self, name, detector):
+        self.layers.append((name, detector))
+        return self
+
+    def transport(self, particle_id, e, angles=None, rng=None,
+                  return_angles=False):
+        """
+        Pushes particles through all layers.
+
+        param: particle_id - name of the particles
+        param: e - array of energies of incident particles in MeV
+        param: angles - array of scattering angles in deg.
+        param: rng - np.random.Generator for resolution smearing
+        param: return_angles - if True, angles after the last layer are
+               returned too
+        Returns (deposits, e_residual) - dict of energy deposits in each
+        layer by layer name and residual energies after the last layer.
+        Layers having layer_scattering() change angles seen by the next
+        layers.
+        """
+        e = np.asarray(e, dtype=float)
+        deposits = OrderedDict()
+        for name, detector in self.layers:
+            de = detector.layer_e_loss(particle_id, e, angles, rng)
+            deposits[name] = de
+            # measured deposit can exceed particle energy due to resolution
+            e_out = np.maximum(e - de, 0.)
+            scattering = getattr(detector, 'layer_scattering', None)
+            if scattering is not None:
+                angles = scattering(particle_id, e, e_out, angles, rng)
+            e = e_out
+        if return_angles:
+            return deposits, e, angles
+        return deposits, e
+
+
 class EspriPlastic(Detector):
 
     def __init__(self, material_id, thickness=4.):
@@ -20,22 +110,19 @@ class EspriPlastic(Detector):
         # plastic resolution, percents from e-loss
         self.resolution_sigma = 5e-2
 
-    def get_resolution_error(self, e_loss):
-        if e_loss <= 1e-3:
-            return 0
-        err = np.random.normal(0, e_loss * self.resolution_sigma)
-        return err
-
-    def e_loss(self, particle_id, e):
+    def e_loss(self, particle_id, e, rng=None):
         """
         Computes e-loss inside this plastic for a given particle type.
 
-        param: e - Energy of the incident particle
+        param: e - Energy of the incident particle, scalar or array
         param particle_id - Name of the particle
+        param: rng - np.random.Generator used for resolution smearing,
+               if None global np.random state is used
         """
         stop_pow = self._find_stop_pow(particle_id)
-        e_loss = stop_pow.e_loss(particle_id, e, self.thickness)
-        e_loss += self.get_resolution_error(e_loss)
+        e_loss = stop_pow.e_loss(particle_id, e, self.thickness,
+                                 straggling=self.straggling, rng=rng)
+        e_loss = e_loss + self.get_resolution_error(e_loss, rng)
         return e_loss
 
 
@@ -53,22 +140,19 @@ class EspriNaI(Detector):
         # crystal resolution, percents from e-loss
         self.resolution_sigma = 2e-2
 
-    def get_resolution_error(self, e_loss):
-        if e_loss <= 1e-3:
-            return 0
-        err = np.random.normal(0, e_loss * self.resolution_sigma)
-        return err
-
-    def e_loss(self, particle_id, e):
+    def e_loss(self, particle_id, e, rng=None):
         """
-        Computes e-loss inside this plastic for a given particle type.
+        Computes e-loss inside this crystal for a given particle type.
 
-        param: e - Energy of the incident particle
+        param: e - Energy of the incident particle, scalar or array
         param particle_id - Name of the particle
+        param: rng - np.random.Generator used for resolution smearing,
+               if None global np.random state is used
         """
         stop_pow = self._find_stop_pow(particle_id)
-        e_loss = stop_pow.e_loss(particle_id, e, self.thickness)
-        e_loss += self.get_resolution_error(e_loss)
+        e_loss = stop_pow.e_loss(particle_id, e, self.thickness,
+                                 straggling=self.straggling, rng=rng)
+        e_loss = e_loss + self.get_resolution_error(e_loss, rng)
         return e_loss
 
 
@@ -87,6 +171,8 @@ class WedgeEnergyDegrader(Detector):
         self.thickness = thickness
         self.min_thickness = min_thickness
         self.length = length
+        # if True, particles get multiple scattering angular spread
+        self.multiple_scattering = False
 
     def _compute_dist(self, angle_with_base_point, dist_from_target):
         """Computes distance from base of degrader.
@@ -94,8 +180,8 @@ class WedgeEnergyDegrader(Detector):
         param: angle_with_base_point - angle between degrader base and
                the point to which we compute the distance
         """
-        d = 2 * dist_from_target * math.tan(
-            np.radians(angle_with_base_point / 2))
+        d = 2 * dist_from_target * np.tan(
+            np.radians(angle_with_base_point / 2.))
         return d
 
     def thickness_at(self, distance_from_base):
@@ -103,19 +189,80 @@ class WedgeEnergyDegrader(Detector):
         tan_angle = self.thickness / self.length
         length2 = self.length - distance_from_base
         t = length2 * tan_angle
-        return t if t >= self.min_thickness else 0.
+        t = np.where(t >= self.min_thickness, t, 0.)
+        return t if t.ndim else t.item()
 
-    def e_loss(self, particle_id, e, scattering_angle):
+    def e_loss(self, particle_id, e, scattering_angle, rng=None):
         """
-        Computes e-loss inside this plastic for a given particle type.
+        Computes e-loss inside this degrader for a given particle type.
+
+        Energies and angles can be scalars or arrays of the same shape.
 
         param: e - Energy of the incident particle
         param particle_id - Name of the particle
+        param: scattering_angle - Scattering angle(s) in deg.
+        param: rng - np.random.Generator to sample straggling from,
+               degrader has no resolution
         """
-        if scattering_angle < self.base_angle:
-            return 0.
         stop_pow = self._find_stop_pow(particle_id)
-        dist_from_base = self._compute_dist(scattering_angle - self.base_angle,
-                                            self.dist_from_target)
-        return stop_pow.e_loss(particle_id, e,
-                               self.thickness_at(dist_from_base))
+        thickness = self.thickness_for(scattering_angle)
+        e_loss = stop_pow.e_loss(particle_id, e, thickness,
+                                 straggling=self.straggling, rng=rng)
+        # particles passing by the degrader base do not hit it
+        e_loss = np.where(scattering_angle < self.base_angle, 0., e_loss)
+        return e_loss if e_loss.ndim else e_loss.item()
+
+    def thickness_for(self, scattering_angle):
+        """Computes thicknesses crossed by particles at given angles."""
+        with timing.stage('degrader_geometry'):
+            dist_from_base = self._compute_dist(
+                scattering_angle - self.base_angle, self.dist_from_target)
+            return self.thickness_at(dist_from_base)
+
+    def scattering_sigma(self, particle_id, e_in, e_out, thickness):
+        """
+        Computes width of projected multiple scattering angle in deg.
+
+        Highland formula is used with momentum at the mean of incident
+        and exit energies.
+
+        param: e_in, e_out - energies of particles at entry & exit in MeV
+        param: thickness - crossed thicknesses in mm
+        """
+        mass = PARTICLE_MASSES[particle_id]
+        charge = PARTICLE_CHARGES[particle_id]
+        x0 = MATERIAL_PROPERTIES[self.material_id]['radiation_length']
+        t = 0.5 * (np.asarray(e_in) + np.asarray(e_out))
+        crossed = (np.asarray(thickness) > 0) & (t > 0)
+        # p*beta*c & beta^2 from kin. energy, dummy values where nothing
+        # is crossed
+        t = np.where(crossed, t, 1.)
+        p2 = t * (t + 2 * mass)
+        p_beta = p2 / (t + mass)
+        beta2 = p2 / (t + mass) ** 2
+        x = np.where(crossed, thickness, x0) / x0
+        theta = (13.6 / p_beta * charge * np.sqrt(x) *
+                 (1 + 0.038 * np.log(x * charge ** 2 / beta2)))
+        return np.degrees(np.where(crossed, theta, 0.))
+
+    def layer_e_loss(self, particle_id, e, angles=None, rng=None):
+        return self.e_loss(particle_id, e, angles, rng)
+
+    def layer_scattering(self, particle_id, e_in, e_out, angles, rng=None):
+        """
+        Returns angles of particles after the degrader.
+
+        Projected scattering angle in the plane of the degrader is added to
+        the angles if multiple scattering is on, otherwise they are
+        returned as they are.
+        """
+        if not self.multiple_scattering:
+            return angles
+        if rng is None:
+            rng = np.random
+        with timing.stage('multiple_scattering'):
+            thickness = np.where(angles < self.base_angle, 0.,
+                                 self.thickness_for(angles))
+            sigma = self.scattering_sigma(particle_id, e_in, e_out,
+                                          thickness)
+            return angles + rng.normal(0, sigma)
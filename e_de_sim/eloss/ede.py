@@ -1,9 +1,15 @@
+import io
+import os
 import re
+import hashlib
+import tempfile
 from os import listdir
-from os.path import isfile, join
+from os.path import isfile, isdir, join, abspath, basename, dirname
 import numpy as np
 import pandas as pd
 
+from . import timing
+
 
 # particle names/IDs
 
@@ -21,41 +27,171 @@ BC400_ID = 'BC400'
 BRASS_ID = 'Brass'
 
 
+# particle & material properties
+
+
+# charges in units of e & masses in MeV/c^2 of particles
+PARTICLE_CHARGES = {PROTON_ID: 1, DEUTERON_ID: 1, TRITIUM_ID: 1}
+PARTICLE_MASSES = {PROTON_ID: 938.272, DEUTERON_ID: 1875.613,
+                   TRITIUM_ID: 2808.921}
+
+# properties of materials for straggling & multiple scattering, their
+# compositions are the ones of bundled SRIM tables:
+#  - density in g/cm3
+#  - z_over_a - mean ratio of atomic number to atomic mass
+#  - radiation_length in mm
+MATERIAL_PROPERTIES = {
+    NAI_ID: {'density': 3.667, 'z_over_a': 0.4270,
+             'radiation_length': 25.88},
+    BC400_ID: {'density': 1.103, 'z_over_a': 0.5416,
+               'radiation_length': 398.1},
+    BRASS_ID: {'density': 8.52, 'z_over_a': 0.4517,
+               'radiation_length': 13.67},
+}
+
+# Bohr straggling variance per unit length is
+# BOHR_STRAGGLING_K * z^2 * Z/A * density, in MeV^2/mm
+BOHR_STRAGGLING_K = 0.01569
+
+
 # data directories
 
 
-DEFAULT_STOPPING_POWERS_DATA_DIR = "data"
+DEFAULT_STOPPING_POWERS_DATA_DIR = join(dirname(dirname(abspath(__file__))),
+                                        "data")
+# name of directory (inside of the data dir) with binary stopping power cache
+SRIM_CACHE_DIR_NAME = ".srim_cache"
+# version of normalized tables format, bump it to invalidate cached tables
+SRIM_CACHE_VERSION = 2
+
+
+# columns of normalized stopping power tables, energies in MeV,
+# stopping powers in MeV/mm, ranges in mm
+STOPPING_POWER_COLUMNS = ['e', 'elec_de', 'nuc_de', 'tot_de', 'range']
 
 
 ### I/O helpers
 
 
+# SRIM units to MeV & mm
+SRIM_ENERGY_UNITS = {'eV': 1e-6, 'keV': 1e-3, 'MeV': 1., 'GeV': 1e3}
+SRIM_RANGE_UNITS = {'A': 1e-7, 'um': 1e-3, 'mm': 1., 'm': 1e3, 'km': 1e6}
+SRIM_STOPPING_UNITS = {'MeV / mm': 1., 'keV / micron': 1.,
+                       'eV / Angstrom': 10.}
+
+# header line underlining six column names, it precedes the data block:
+#   --------------  ---------- ---------- ----------  ----------  ----------
+SRIM_HEADER_MARKER = re.compile(r'^[ \t]*-+(?:[ \t]+-+){5,}[ \t]*\r?$',
+                                re.M)
+# line after the data block:
+# -----------------------------------------------------------
+SRIM_FOOTER_MARKER = re.compile(r'^-+[ \t]*\r?$', re.M)
+SRIM_STOPPING_UNITS_LINE = re.compile(r'Stopping Units\s*=\s*(.+?)\s*$',
+                                      re.M)
+
+
 def read_srim_stopping_power_csv(input_file):
     """
     Helper to read stopping power data from SRIM csv format.
+
+    Data block is located by the header & footer markers and parsed at once,
+    units are normalized to MeV & mm. Rows are sorted by energy.
     """
-    df = pd.read_csv(input_file, sep=r"\s+", skiprows=25, skipfooter=13,
-                     header=None, usecols=[0, 1, 2, 3, 4, 5], engine='python')
+    with open(input_file) as f:
+        text = f.read()
+
+    header = SRIM_HEADER_MARKER.search(text)
+    if header is None:
+        raise ValueError('No SRIM data header found in: "{}"'.format(
+            input_file))
+    footer = SRIM_FOOTER_MARKER.search(text, header.end())
+    data_end = footer.start() if footer is not None else len(text)
+    stopping_units = SRIM_STOPPING_UNITS_LINE.search(text, 0, header.start())
+    stopping_units = stopping_units.group(1) if stopping_units else 'MeV / mm'
+    if stopping_units not in SRIM_STOPPING_UNITS:
+        raise ValueError('Unknown SRIM stopping units: "{}" in "{}"'.format(
+            stopping_units, input_file))
+
+    df = pd.read_csv(io.StringIO(text[header.end():data_end]), sep=r"\s+",
+                     header=None, usecols=[0, 1, 2, 3, 4, 5])
     df.columns = ['e', 'e_units', 'elec_de', 'nuc_de', 'range', 'range_units']
 
     # normalize units, all to MeV & mm
-    df_rows = []
-    for index, row in df.iterrows():
-        if row['e_units'] == 'keV':
-            row['e'] *= 1e-3
-            row['elec_de'] *= 1e-3
-            row['nuc_de'] *= 1e-3
-        if row['range_units'] == 'um':
-            row['range'] *= 1e-3
-        elif row['range_units'] == 'm':
-            row['range'] *= 1e3
-        df_rows.append(row)
-    df_norm = pd.DataFrame(df_rows, columns=df.columns)
-    del df_norm['e_units']
-    del df_norm['range_units']
+    e_mul = df['e_units'].map(SRIM_ENERGY_UNITS).values
+    range_mul = df['range_units'].map(SRIM_RANGE_UNITS).values
+    if np.isnan(e_mul).any() or np.isnan(range_mul).any():
+        raise ValueError('Unknown SRIM units in: "{}"'.format(input_file))
+    de_mul = SRIM_STOPPING_UNITS[stopping_units]
+    df_norm = pd.DataFrame({
+        'e': df['e'].values * e_mul,
+        'elec_de': df['elec_de'].values * de_mul,
+        'nuc_de': df['nuc_de'].values * de_mul,
+        'range': df['range'].values * range_mul},
+        columns=['e', 'elec_de', 'nuc_de', 'range'])
     df_norm['tot_de'] = df_norm['elec_de'] + df_norm['nuc_de']
-    df.norm = df_norm.sort(['e'])
-    return df_norm
+    return df_norm.sort_values('e').reset_index(drop=True)
+
+
+def _srim_cache_key(input_file):
+    """Key of a SRIM file in the cache: hash of its path, size & mtime."""
+    st = os.stat(input_file)
+    key = '{}:{}:{}:{}'.format(SRIM_CACHE_VERSION, abspath(input_file),
+                               st.st_size, st.st_mtime)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _write_srim_cache(cache_dir, input_file, cache_file, table):
+    """Atomically writes a table to the cache, then drops stale entries
+    of the same SRIM file."""
+    if not isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        np.save(tmp, table)
+    os.rename(tmp_file, cache_file)
+    prefix = basename(input_file) + '.'
+    for f in listdir(cache_dir):
+        if f.startswith(prefix) and f.endswith('.npy') and \
+                f != basename(cache_file):
+            try:
+                os.remove(join(cache_dir, f))
+            except OSError:
+                # removed by a concurrent loader
+                pass
+
+
+def load_srim_stopping_power(input_file, cache_dir=None):
+    """
+    Reads stopping power data from SRIM file through a binary cache.
+
+    Normalized tables are kept as .npy files keyed by path, size and mtime
+    of the source file. Cached tables are memory-mapped, stale or missing
+    ones are rebuilt from the SRIM file.
+
+    param: input_file - SRIM stopping power file
+    param: cache_dir - cache directory, by default SRIM_CACHE_DIR_NAME
+           next to the input file
+    """
+    if cache_dir is None:
+        cache_dir = join(dirname(input_file), SRIM_CACHE_DIR_NAME)
+    cache_file = join(cache_dir, '{}.{}.npy'.format(
+        basename(input_file), _srim_cache_key(input_file)))
+    table = None
+    if isfile(cache_file):
+        try:
+            table = np.load(cache_file, mmap_mode='r')
+        except (IOError, OSError):
+            # dropped by a concurrent writer after the check
+            pass
+    if table is None:
+        df = read_srim_stopping_power_csv(input_file)
+        table = df[STOPPING_POWER_COLUMNS].values.astype(float)
+        try:
+            _write_srim_cache(cache_dir, input_file, cache_file, table)
+        except (IOError, OSError):
+            # read-only data location, work without the cache
+            pass
+    return pd.DataFrame(table, columns=STOPPING_POWER_COLUMNS)
 
 
 def read_kinematics_csv(input_file):
@@ -64,23 +200,31 @@ def read_kinematics_csv(input_file):
     """
     df = pd.read_csv(input_file)
     df.columns = ['a', 'e']
-    df = df.sort(['a'])
+    df = df.sort_values('a').reset_index(drop=True)
     return df
 
 
 class MaterialStoppingPower:
 
-    def __init__(self, material_id, stopping_power_csv_file, particle_id):
+    def __init__(self, material_id, stopping_power_csv_file, particle_id,
+                 cache_dir=None):
         """
         param: material_id - name of the material
         param: stopping_power_csv_file - SRIM stopping power data
         param: particle_id - particle name, for what particle
                this stopping power is
+        param: cache_dir - binary cache directory for SRIM tables,
+               see load_srim_stopping_power()
         """
         self.material_id = material_id
-        self.stop_pow_data = read_srim_stopping_power_csv(
-            stopping_power_csv_file)
+        self.stop_pow_data = load_srim_stopping_power(
+            stopping_power_csv_file, cache_dir)
         self.particle_id = particle_id
+        # plain arrays for interpolation in the per-event path
+        self._e = self.stop_pow_data['e'].values
+        self._range = self.stop_pow_data['range'].values
+        self._tot_de = self.stop_pow_data['tot_de'].values
+        self._variance = None
 
     def __str__(self):
         return name
@@ -90,19 +234,24 @@ class MaterialStoppingPower:
         return np.interp(e, self.stop_pow_data['e'],
                          self.stop_pow_data['tot_de'])
 
-    def e_loss(self, particle_id, e, z, step=0.1):
+    def e_loss(self, particle_id, e, z, step=0.1, straggling=False,
+               rng=None):
         """
         Computes energy loss for a given thickness.
 
+        Energies and thicknesses can be scalars or arrays of the same
+        (or broadcastable) shapes, scalar inputs give a scalar result.
+
         param: particle_id - name of the particle
         param: e - energy of the incoming particle in MeV
         param: z - thickness for e-loss calculation in mm
+        param: straggling - if True, energy straggling is sampled,
+               see straggling_sigma()
+        param: rng - np.random.Generator to sample straggling from,
+               if None global np.random state is used
         """
-        if particle_id != self.particle_id:
-            raise ValueError('Particle ID of this stopping power: {} cannot'
-                             'be used with this particle: {}'.format(
-                                 self.particle_id, particle_id))
-        if e < 0:
+        self._check_particle(particle_id)
+        if np.any(np.asarray(e) < 0):
             raise ValueError('Kin. energy cannot be lower than zero!')
 
         # loss, depth = 0.0, 0.0
@@ -116,61 +265,221 @@ class MaterialStoppingPower:
         #     depth += step
         # return loss
 
-        particle_range = np.interp(e, self.stop_pow_data['e'],
-                                   self.stop_pow_data['range'])
-        if particle_range <= z:
-            return e
-        else:
-            return e - np.interp(
-                particle_range - z, self.stop_pow_data['range'],
-                self.stop_pow_data['e'])
+        # works on scalars as well as on arrays of energies, particles
+        # which stop inside the material lose all of their energy
+        with timing.stage('stopping_power'):
+            particle_range = np.interp(e, self._e, self._range)
+            e_residual = np.interp(particle_range - z, self._range, self._e)
+            loss = np.where(particle_range <= z, e, e - e_residual)
+        if straggling:
+            if rng is None:
+                rng = np.random
+            with timing.stage('straggling'):
+                sigma = self._straggling_sigma(particle_range,
+                                               particle_range - z, e_residual)
+                loss = np.clip(loss + rng.normal(0, sigma), 0, e)
+        return loss if loss.ndim else loss.item()
+
+    def straggling_sigma(self, particle_id, e, z):
+        """
+        Computes sigma of energy loss straggling for a given thickness.
+
+        Bohr straggling variance accumulated along the path is carried to
+        the exit energy: sigma_out^2 = S(E_out)^2 * [W(R_in) - W(R_out)],
+        where W(R) = integral over range of (dOmega^2/dx) / S^2 is
+        precomputed on the range grid. Particles stopping inside of the
+        material have no straggling.
+
+        param: particle_id - name of the particle
+        param: e - energy of the incoming particle in MeV
+        param: z - thickness in mm
+        """
+        self._check_particle(particle_id)
+        particle_range = np.interp(e, self._e, self._range)
+        e_residual = np.interp(particle_range - z, self._range, self._e)
+        sigma = self._straggling_sigma(particle_range, particle_range - z,
+                                       e_residual)
+        return sigma if sigma.ndim else sigma.item()
+
+    def _straggling_sigma(self, range_in, range_out, e_out):
+        w = self._variance_table()
+        s_out = np.interp(e_out, self._e, self._tot_de)
+        variance = s_out ** 2 * (np.interp(range_in, self._range, w) -
+                                 np.interp(range_out, self._range, w))
+        return np.where(range_out > 0, np.sqrt(np.maximum(variance, 0.)), 0.)
+
+    def _variance_table(self):
+        """Returns W(R) on the range grid, in mm^2."""
+        if self._variance is None:
+            material = MATERIAL_PROPERTIES.get(self.material_id)
+            charge = PARTICLE_CHARGES.get(self.particle_id)
+            if material is None or charge is None:
+                raise ValueError('Straggling of {} in {} is not supported, '
+                                 'its properties are unknown'.format(
+                                     self.particle_id, self.material_id))
+            d_variance = (BOHR_STRAGGLING_K * charge ** 2 *
+                          material['z_over_a'] * material['density'])
+            inv_s2 = 1. / self._tot_de ** 2
+            # integral from zero range, stopping power is constant below
+            # the first tabulated point
+            w = np.concatenate(([0.], np.cumsum(
+                0.5 * (inv_s2[1:] + inv_s2[:-1]) * np.diff(self._range))))
+            self._variance = d_variance * (w + inv_s2[0] * self._range[0])
+        return self._variance
+
+    def _check_particle(self, particle_id):
+        if particle_id != self.particle_id:
+            raise ValueError('Particle ID of this stopping power: {} cannot'
+                             'be used with this particle: {}'.format(
+                                 self.particle_id, particle_id))
 
 
 class StoppingPowersStore(object):
+    """
+    Stopping powers from SRIM files named "<particle> in <material>.txt".
+
+    Data files are indexed on the first request and stopping powers are
+    loaded only when they are requested.
+    """
 
-    def __init__(self, stopping_powers_data_dir=DEFAULT_STOPPING_POWERS_DATA_DIR):
+    SRIM_FILE_PATTERN = re.compile(r'(\w+)\s+in\s+(\w+)\.txt$')
+
+    def __init__(self, stopping_powers_data_dir=DEFAULT_STOPPING_POWERS_DATA_DIR,
+                 cache_dir=None):
         self.data_dir = stopping_powers_data_dir
-        self.stopping_powers = []
-        self.load_data()
+        self.cache_dir = cache_dir
+        # (material_id, particle_id) -> MaterialStoppingPower
+        self.stopping_powers = {}
+        self._data_files = None
+
+    def data_files(self):
+        """Returns dict of SRIM data files by (material_id, particle_id)."""
+        if self._data_files is None:
+            self._data_files = {}
+            for f in listdir(self.data_dir):
+                fname_match = self.SRIM_FILE_PATTERN.match(f)
+                if fname_match and isfile(join(self.data_dir, f)):
+                    particle_id, material_id = fname_match.groups()
+                    self._data_files[(material_id, particle_id)] = \
+                        join(self.data_dir, f)
+        return self._data_files
 
     def load_data(self):
-        """Scans data directories for files matching patter and tries to load
-        stopping power data from them."""
-        is_srim_data_file = lambda f: isfile(join(self.data_dir, f)) and \
-                            re.match(r'(\w+)\s+in\s+(\w+)\.txt', f, flags=0)
-        data_files = [f for f in listdir(self.data_dir)
-                      if is_srim_data_file(f)]
-        for f in data_files:
-            fname_match = re.match(r'(\w+)\s+in\s+(\w+)\.txt', f, flags=0)
-            particle_id, material_id = fname_match.group(1), fname_match.group(2)
-            print 'reading stopping power for {} in {}'.format(particle_id, material_id)
-            self.stopping_powers.append(MaterialStoppingPower(
-                material_id, join(self.data_dir, f), particle_id))
+        """Loads all stopping powers found in the data directory."""
+        for material_id, particle_id in self.data_files():
+            self.find(material_id, particle_id)
 
     def find(self, material_id, particle_id):
-        for stop_pow in self.stopping_powers:
-            if stop_pow.material_id == material_id and \
-               stop_pow.particle_id == particle_id:
-                return stop_pow
-        raise ValueError(('Requested stopping power: "{} in {}" '
-                          'does not exist'.format(particle_id, material_id)))
+        key = (material_id, particle_id)
+        stop_pow = self.stopping_powers.get(key)
+        if stop_pow is not None:
+            return stop_pow
+        data_file = self.data_files().get(key)
+        if data_file is None:
+            raise ValueError(('Requested stopping power: "{} in {}" '
+                              'does not exist'.format(particle_id,
+                                                      material_id)))
+        print('reading stopping power for {} in {}'.format(particle_id,
+                                                           material_id))
+        stop_pow = MaterialStoppingPower(material_id, data_file, particle_id,
+                                         self.cache_dir)
+        self.stopping_powers[key] = stop_pow
+        return stop_pow
 
 
 DEFAULT_STOPPING_POWERS_STORE = StoppingPowersStore()
 
 
-class ReactionKinematics:
+class Kinematics(object):
+    """
+    Base class for kinematics of reaction products: energies of a product
+    as a function of its scattering angle.
+    """
 
-    def __init__(self, particle_id, kinematics_csv_file):
+    def __init__(self, particle_id):
         """
         param: particle_id - name of a particle for which this kinematics is
         """
         self.particle_id = particle_id
-        self.kin_data = read_kinematics_csv(kinematics_csv_file)
 
     def __getitem__(self, angle):
         """Returns energy as a function of angle."""
-        return np.interp(angle, self.kin_data['a'], self.kin_data['e'])
+        return self.sample(angle)
+
+    def sample(self, angles, rng=None):
+        """
+        Returns energies in MeV for a batch of angles.
+
+        param: angles - scattering angle(s) in lab deg., scalar or array
+        param: rng - np.random.Generator for random kinematics, if None
+               global np.random state is used
+        """
+        raise NotImplementedError()
+
+    def load(self):
+        """Loads tables used by sample(), e.g. before forking workers."""
+        return self
+
+
+# amount of points of uniform angular grids of tabulated kinematics
+DEFAULT_KINEMATICS_GRID_POINTS = 20001
+
+
+class ReactionKinematics(Kinematics):
+    """
+    Kinematics tabulated in CSV file.
+
+    Table is loaded on the first use and resampled onto a uniform angular
+    grid, so that lookup of an angle is an index computation instead of
+    a binary search.
+    """
+
+    def __init__(self, particle_id, kinematics_csv_file, e_scale=1.,
+                 grid_points=DEFAULT_KINEMATICS_GRID_POINTS):
+        """
+        param: particle_id - name of a particle for which this kinematics is
+        param: kinematics_csv_file - CSV file with angles & energies
+        param: e_scale - factor for tabulated energies, e.g. 2 to get
+               total kin. energy of a deuteron from MeV/u
+        param: grid_points - amount of points of the uniform angular grid
+        """
+        super(ReactionKinematics, self).__init__(particle_id)
+        self.kinematics_csv_file = kinematics_csv_file
+        self.e_scale = e_scale
+        self.grid_points = grid_points
+        self._kin_data = None
+        self._grid = None
+
+    @property
+    def kin_data(self):
+        if self._kin_data is None:
+            self._kin_data = read_kinematics_csv(self.kinematics_csv_file)
+            self._kin_data['e'] = self._kin_data['e'] * self.e_scale
+        return self._kin_data
+
+    def _uniform_grid(self):
+        """Returns (first angle, 1 / step, energies, slopes) of the grid."""
+        if self._grid is None:
+            a = self.kin_data['a'].values
+            angles = np.linspace(a[0], a[-1], self.grid_points)
+            e = np.interp(angles, a, self.kin_data['e'].values)
+            step = angles[1] - angles[0]
+            self._grid = (angles[0], 1. / step, e, np.diff(e))
+        return self._grid
+
+    def load(self):
+        self._uniform_grid()
+        return self
+
+    def sample(self, angles, rng=None):
+        """Returns energies for given angles, rng is not used."""
+        a0, inv_step, e, slopes = self._uniform_grid()
+        # fractional grid index, out of table angles get edge energies
+        x = np.clip((np.asarray(angles, dtype=float) - a0) * inv_step,
+                    0, len(e) - 1)
+        idx = np.minimum(x.astype(np.intp), len(e) - 2)
+        res = e[idx] + slopes[idx] * (x - idx)
+        return res if res.ndim else res.item()
 
 
 class Detector(object):
@@ -183,7 +492,47 @@ class Detector(object):
             self.stopping_powers_store = DEFAULT_STOPPING_POWERS_STORE
         else:
             self.stopping_powers_store = stopping_powers_store
+        # detector resolution, percents from e-loss
+        self.resolution_sigma = 0.
+        # if True, energy straggling is sampled in e-loss computations
+        self.straggling = False
+        # stopping powers resolved for this detector, by particle ID
+        self._stop_pows = {}
+
+    def get_resolution_error(self, e_loss, rng=None):
+        """
+        Samples resolution errors for given energy losses.
+
+        param: e_loss - energy loss(es) in MeV, scalar or array
+        param: rng - np.random.Generator to sample from, if None
+               global np.random state is used
+        """
+        if rng is None:
+            rng = np.random
+        with timing.stage('resolution'):
+            e_loss = np.asarray(e_loss)
+            sigma = np.where(e_loss <= 1e-3, 0.,
+                             e_loss * self.resolution_sigma)
+            return rng.normal(0, sigma)
+
+    def layer_e_loss(self, particle_id, e, angles=None, rng=None):
+        """
+        Computes e-loss of this detector as a layer of a DetectorStack.
+
+        Detectors with angle dependent response override it.
+
+        param: particle_id - name of the particle
+        param: e - energies of incident particles in MeV
+        param: angles - scattering angles of particles in deg.
+        param: rng - np.random.Generator for resolution smearing
+        """
+        return self.e_loss(particle_id, e, rng=rng)
 
     def _find_stop_pow(self, particle_id):
         """Tries to find suitable stopping power for a given particle ID."""
-        return self.stopping_powers_store.find(self.material_id, particle_id)
+        stop_pow = self._stop_pows.get(particle_id)
+        if stop_pow is None:
+            stop_pow = self.stopping_powers_store.find(self.material_id,
+                                                       particle_id)
+            self._stop_pows[particle_id] = stop_pow
+        return stop_pow
@@ -0,0 +1,107 @@
+import numpy as np
+
+
+# E & dE ranges of dE-E spectra in MeV
+E_RANGE = (0., 200.)
+DE_RANGE = (0., 37.)
+DEFAULT_BINS = 120
+
+
+class Hist2D(object):
+    """
+    Fixed-bin 2D histogram accumulated from chunks of events.
+
+    Memory does not depend on the amount of events: chunks are binned as
+    they come and only the counts are kept. Histograms with the same bins
+    (e.g. filled by parallel workers) can be merged.
+    """
+
+    def __init__(self, x_range=E_RANGE, y_range=DE_RANGE, bins=DEFAULT_BINS):
+        """
+        param: x_range - (min, max) of x axis, E in MeV by default
+        param: y_range - (min, max) of y axis, dE in MeV by default
+        param: bins - amount of bins, a number or (x bins, y bins)
+        """
+        x_bins, y_bins = (bins, bins) if np.ndim(bins) == 0 else bins
+        self.x_edges = np.linspace(x_range[0], x_range[1], x_bins + 1)
+        self.y_edges = np.linspace(y_range[0], y_range[1], y_bins + 1)
+        self.counts = np.zeros((x_bins, y_bins), dtype=np.int64)
+        # amount of filled events including ones out of histogram range
+        self.entries = 0
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    def copy(self):
+        other = type(self).__new__(type(self))
+        other.x_edges = self.x_edges
+        other.y_edges = self.y_edges
+        other.counts = self.counts.copy()
+        other.entries = self.entries
+        return other
+
+    def empty_copy(self):
+        """Returns histogram with the same bins and no counts."""
+        other = self.copy()
+        other.counts[:] = 0
+        other.entries = 0
+        return other
+
+    def _bin_indices(self, values, edges):
+        """Uniform bins lookup, right edge goes to the last bin like in
+        np.histogram. Out of range values get -1."""
+        n = len(edges) - 1
+        idx = np.floor((values - edges[0]) * (n / (edges[-1] - edges[0])))
+        idx = np.where(values == edges[-1], n - 1, idx)
+        return np.where((idx >= 0) & (idx < n), idx, -1).astype(np.intp)
+
+    def fill(self, x, y):
+        """
+        Adds a chunk of events.
+
+        param: x - array of x values (E)
+        param: y - array of y values (dE)
+        """
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        ix = self._bin_indices(x, self.x_edges)
+        iy = self._bin_indices(y, self.y_edges)
+        inside = (ix >= 0) & (iy >= 0)
+        flat_idx = ix[inside] * self.counts.shape[1] + iy[inside]
+        self.counts += np.bincount(
+            flat_idx, minlength=self.counts.size).reshape(self.counts.shape)
+        self.entries += x.size
+        return self
+
+    def merge(self, other):
+        """Adds counts of another histogram with the same bins."""
+        if not (np.array_equal(self.x_edges, other.x_edges) and
+                np.array_equal(self.y_edges, other.y_edges)):
+            raise ValueError('Cannot merge histograms with different bins')
+        self.counts += other.counts
+        self.entries += other.entries
+        return self
+
+    __iadd__ = merge
+
+    def save(self, path):
+        """Saves histogram into compressed .npz file."""
+        np.savez_compressed(path, counts=self.counts, x_edges=self.x_edges,
+                            y_edges=self.y_edges, entries=self.entries)
+
+    @classmethod
+    def load(cls, path):
+        """Loads histogram saved by save()."""
+        with np.load(path) as data:
+            hist = cls.__new__(cls)
+            hist.counts = data['counts']
+            hist.x_edges = data['x_edges']
+            hist.y_edges = data['y_edges']
+            hist.entries = int(data['entries'])
+        return hist
+
+
+def fill_e_de_hist(hist, results):
+    """Fills Hist2D with E (NaI e-loss) vs dE (plastic) of results."""
+    hist.fill(results['nai_e_loss'].values, results['de'].values)
+    return hist
@@ -0,0 +1,372 @@
+"""
+Relativistic two-body reaction kinematics.
+
+Energies of a reaction product as a function of its lab angle are
+computed for a beam hitting a target at rest: A(a, b)B, where a is the
+beam, A - target, b - detected particle & B - the residual.
+"""
+
+import io
+
+import pandas as pd
+import numpy as np
+
+from .ede import ReactionKinematics, PROTON_ID, DEUTERON_ID, TRITIUM_ID, \
+    PARTICLE_MASSES
+
+
+# particle names/IDs, in addition to ones of ede module
+
+
+NEUTRON_ID = 'Neutron'
+HE3_ID = 'He3'
+HE4_ID = 'He4'
+HE6_ID = 'He6'
+C12_ID = 'C12'
+
+
+# nuclear masses in MeV/c^2
+NUCLEAR_MASSES = dict(PARTICLE_MASSES)
+NUCLEAR_MASSES.update({NEUTRON_ID: 939.565, HE3_ID: 2808.392,
+                       HE4_ID: 3727.379, HE6_ID: 5605.538,
+                       C12_ID: 11174.863})
+# mass numbers, to convert beam energies from MeV/u
+MASS_NUMBERS = {NEUTRON_ID: 1, PROTON_ID: 1, DEUTERON_ID: 2, TRITIUM_ID: 3,
+                HE3_ID: 3, HE4_ID: 4, HE6_ID: 6, C12_ID: 12}
+
+# step of tabulated angles in deg.
+DEFAULT_ANGLE_STEP = 0.01
+# hbar * c in MeV * fm
+HBAR_C = 197.3269804
+# amount of points of inverse CDF tables of angular distributions
+DEFAULT_CDF_POINTS = 10001
+# amount of bisection steps finding scattering angles at region edges
+REGION_EDGE_STEPS = 60
+
+
+def two_body_energies(m_beam, m_target, m_ejectile, m_residual, t_beam,
+                      angles, branch=1):
+    """
+    Computes kinetic energies of an ejectile at given lab angles.
+
+    From energy & momentum conservation:
+    E * E3 - P * p3 * cos(theta) = (s + m3^2 - m4^2) / 2, where E & P are
+    total energy & momentum in the lab and s - invariant mass squared.
+
+    param: m_beam, m_target, m_ejectile, m_residual - masses in MeV/c^2
+    param: t_beam - kinetic energy of the beam in MeV
+    param: angles - lab angles of the ejectile in deg., scalar or array
+    param: branch - 1 or -1, solution with higher or lower energy at
+           angles where there are two of them
+    Returns kinetic energies in MeV, NaN where angle is out of the
+    kinematically allowed range.
+    """
+    e_beam = t_beam + m_beam
+    p = np.sqrt(t_beam * (t_beam + 2 * m_beam))
+    e = e_beam + m_target
+    s = m_beam ** 2 + m_target ** 2 + 2 * m_target * e_beam
+    a = (s + m_ejectile ** 2 - m_residual ** 2) / 2.
+    cos_theta = np.cos(np.radians(angles))
+    d = e ** 2 - (p * cos_theta) ** 2
+    discriminant = a ** 2 - m_ejectile ** 2 * d
+    root = np.sqrt(np.maximum(discriminant, 0.))
+    p_ejectile = (a * p * cos_theta + branch * e * root) / d
+    # e.g. recoils of elastic scattering are at rest at & beyond 90 deg.,
+    # their discriminant & momentum are zero up to rounding there
+    valid = (discriminant >= -1e-12 * a ** 2) & (p_ejectile > -1e-9 * p)
+    p2 = np.maximum(p_ejectile, 0.) ** 2
+    # same as sqrt(p^2 + m^2) - m without loss of precision at low p
+    t = p2 / (np.sqrt(p2 + m_ejectile ** 2) + m_ejectile)
+    t = np.where(valid, t, np.nan)
+    return t if t.ndim else t.item()
+
+
+# reaction -> table of angles & energies, shared by all instances
+_KINEMATICS_TABLES = {}
+
+
+class TwoBodyKinematics(ReactionKinematics):
+    """
+    Kinematics of a two-body reaction computed from masses.
+
+    Energies are tabulated once per reaction on a uniform angular grid
+    and the table is shared by all instances with the same reaction.
+    """
+
+    def __init__(self, beam, target, particle_id, beam_energy,
+                 residual=None, branch=1, angle_step=DEFAULT_ANGLE_STEP):
+        """
+        param: beam, target - particle IDs of beam & target at rest
+        param: particle_id - particle ID of the detected product
+        param: beam_energy - kinetic energy of the beam in MeV/u
+        param: residual - particle ID of the other product, by default
+               the reaction is elastic scattering
+        param: branch - 1 or -1, see two_body_energies()
+        param: angle_step - step of tabulated angles in deg.
+        """
+        if residual is None:
+            if particle_id not in (beam, target):
+                raise ValueError('Residual of {}({}, {}) is not set'.format(
+                    target, beam, particle_id))
+            residual = target if particle_id == beam else beam
+        for pid in (beam, target, particle_id, residual):
+            if pid not in NUCLEAR_MASSES:
+                raise ValueError('Unknown mass of "{}", known are: {}'.format(
+                    pid, sorted(NUCLEAR_MASSES)))
+        n_points = int(round(180. / angle_step)) + 1
+        super(TwoBodyKinematics, self).__init__(particle_id, None,
+                                                grid_points=n_points)
+        self.beam = beam
+        self.target = target
+        self.residual = residual
+        self.beam_energy = beam_energy
+        self.branch = branch
+        # AngularDistribution to sample angles of events from, if None
+        # angles are uniform
+        self.angular_distribution = None
+
+    def reaction(self):
+        return (self.beam, self.target, self.particle_id, self.residual,
+                self.beam_energy, self.branch, self.grid_points)
+
+    def __str__(self):
+        return '{}({}, {}){} at {} MeV/u'.format(
+            self.target, self.beam, self.particle_id, self.residual,
+            self.beam_energy)
+
+    def q_value(self):
+        m = NUCLEAR_MASSES
+        return (m[self.beam] + m[self.target] - m[self.particle_id] -
+                m[self.residual])
+
+    def energies(self, angles):
+        """Computes energies in MeV at given lab angles in deg. exactly."""
+        m = NUCLEAR_MASSES
+        return two_body_energies(
+            m[self.beam], m[self.target], m[self.particle_id],
+            m[self.residual], self.beam_energy * MASS_NUMBERS[self.beam],
+            angles, self.branch)
+
+    @property
+    def kin_data(self):
+        if self._kin_data is None:
+            key = self.reaction()
+            table = _KINEMATICS_TABLES.get(key)
+            if table is None:
+                a = np.linspace(0., 180., self.grid_points)
+                table = pd.DataFrame({'a': a, 'e': self.energies(a)},
+                                     columns=['a', 'e'])
+                _KINEMATICS_TABLES[key] = table
+            self._kin_data = table
+        return self._kin_data
+
+    def max_angle(self):
+        """Returns max lab angle at which the detected particle moves, in
+        deg."""
+        e = self.kin_data['e'].values
+        moving = e > 1e-9 * np.nanmax(e)
+        return self.kin_data['a'].values[moving].max()
+
+    def _cm(self):
+        """Returns (beta & gamma of CM, momentum & energy of the detected
+        particle in CM) in units of c & MeV."""
+        m = NUCLEAR_MASSES
+        m1, m2, m3, m4 = (m[self.beam], m[self.target], m[self.particle_id],
+                          m[self.residual])
+        t_beam = self.beam_energy * MASS_NUMBERS[self.beam]
+        e = t_beam + m1 + m2
+        p = np.sqrt(t_beam * (t_beam + 2 * m1))
+        s = e ** 2 - p ** 2
+        p3 = np.sqrt(max((s - (m3 + m4) ** 2) * (s - (m3 - m4) ** 2), 0.)) / \
+            (2 * np.sqrt(s))
+        return p / e, e / np.sqrt(s), p3, np.sqrt(p3 ** 2 + m3 ** 2)
+
+    def cm_momentum(self):
+        """Returns momentum of the products in CM in MeV/c."""
+        return self._cm()[2]
+
+    def lab_angles(self, theta_cm):
+        """
+        Converts CM angles of the detected particle to lab angles.
+
+        param: theta_cm - angles between the particle & the beam in CM,
+               in deg.
+        """
+        beta, gamma, p3, e3 = self._cm()
+        theta_cm = np.radians(theta_cm)
+        p_parallel = gamma * (p3 * np.cos(theta_cm) + beta * e3)
+        return np.degrees(np.arctan2(p3 * np.sin(theta_cm), p_parallel))
+
+    def scattering_angles(self, q):
+        """
+        Converts momentum transfer of elastic scattering to CM scattering
+        angles in deg.
+
+        param: q - momentum transfer in fm^-1
+        """
+        if sorted((self.particle_id, self.residual)) != \
+                sorted((self.beam, self.target)):
+            raise ValueError('Momentum transfer conversion is implemented '
+                             'for elastic scattering only')
+        x = np.asarray(q) * HBAR_C / (2 * self.cm_momentum())
+        return np.degrees(2 * np.arcsin(np.clip(x, -1., 1.)))
+
+    def cm_angles(self, scattering_angles):
+        """Returns CM angles of the detected particle for CM scattering
+        angles of the beam, i.e. for recoils of the target 180 - angle."""
+        if self.particle_id == self.beam:
+            return np.asarray(scattering_angles)
+        return 180. - np.asarray(scattering_angles)
+
+
+def read_cross_section_csv(input_file):
+    """
+    Reads dsigma/dOmega(q) table exported by Plot Digitizer.
+
+    Returns table with columns "q" (in fm^-1) & "cs" sorted by q.
+    """
+    with open(input_file) as f:
+        lines = f.readlines()
+    header = [i for i, l in enumerate(lines) if l.startswith('q,')][0]
+    df = pd.read_csv(io.StringIO(''.join(lines[header:])))
+    df = pd.DataFrame({'q': df['q'].values, 'cs': df['CS'].values},
+                      columns=['q', 'cs'])
+    return df.sort_values('q').reset_index(drop=True)
+
+
+class AngularDistribution(object):
+    """
+    Samples lab angles of events from dsigma/dOmega of a reaction.
+
+    Distribution of CM scattering angle dsigma/dOmega * sin(theta) is
+    integrated on a fine grid spanning the interval of angles whose lab
+    angles of the detected particle are in the angular region. Its
+    inverse CDF is tabulated on a uniform grid together with lab angles
+    once per region, so sampling of an event is one uniform number and one
+    interpolation.
+    """
+
+    def __init__(self, kinematics, scattering_angles, cross_section,
+                 n_points=DEFAULT_CDF_POINTS):
+        """
+        param: kinematics - TwoBodyKinematics of the reaction
+        param: scattering_angles - CM scattering angles in deg.
+        param: cross_section - dsigma/dOmega in CM at these angles,
+               e.g. in mb/sr
+        param: n_points - amount of points of integration & CDF tables
+        """
+        self.kinematics = kinematics
+        order = np.argsort(scattering_angles)
+        self.scattering_angles = np.asarray(scattering_angles,
+                                            dtype=float)[order]
+        self.cross_section = np.asarray(cross_section, dtype=float)[order]
+        self.n_points = n_points
+        # angular region -> (inverse CDF of lab angles, cross section)
+        self._tables = {}
+
+    @classmethod
+    def from_q(cls, kinematics, q, cross_section, **kwargs):
+        """Makes distribution from dsigma/dOmega as function of momentum
+        transfer q in fm^-1."""
+        return cls(kinematics, kinematics.scattering_angles(q),
+                   cross_section, **kwargs)
+
+    @classmethod
+    def from_csv(cls, kinematics, input_file, **kwargs):
+        """Makes distribution from a dsigma/dOmega(q) CSV, see
+        read_cross_section_csv()."""
+        df = read_cross_section_csv(input_file)
+        return cls.from_q(kinematics, df['q'].values, df['cs'].values,
+                          **kwargs)
+
+    def _lab_angles(self, theta):
+        return self.kinematics.lab_angles(self.kinematics.cm_angles(theta))
+
+    def _in_region(self, theta, angular_region):
+        lab = self._lab_angles(theta)
+        return (lab >= angular_region[0]) & (lab <= angular_region[1])
+
+    def _region_edge(self, inside, outside, angular_region):
+        """Bisects scattering angles between one inside of the region and
+        one outside of it, returns the last angle found inside."""
+        for _ in range(REGION_EDGE_STEPS):
+            middle = 0.5 * (inside + outside)
+            if self._in_region(middle, angular_region):
+                inside = middle
+            else:
+                outside = middle
+        return inside
+
+    def _region_angles(self, angular_region):
+        """Returns (min, max) scattering angles of the interval whose lab
+        angles are in the angular region."""
+        theta = np.linspace(self.scattering_angles[0],
+                            self.scattering_angles[-1], self.n_points)
+        idx = np.flatnonzero(self._in_region(theta, angular_region))
+        if len(idx) == 0:
+            raise ValueError('Cross section is zero in angular region '
+                             '{}'.format(angular_region))
+        if idx[-1] - idx[0] != len(idx) - 1:
+            raise ValueError('Angular region {} is reached from several '
+                             'intervals of scattering angles, which is not '
+                             'supported'.format(angular_region))
+        # ends of the table inside of the region, except of the ends of
+        # all scattering angles, mean that a part of the region is not
+        # covered by the cross section
+        ends = [theta[i] for i in (idx[0], idx[-1])
+                if i in (0, len(theta) - 1) and 0. < theta[i] < 180.]
+        lab = self._lab_angles(np.array(ends))
+        if np.any((lab > angular_region[0]) & (lab < angular_region[1])):
+            tabulated = np.sort(self._lab_angles(theta[[0, -1]]))
+            raise ValueError('Angular region {} extends past lab angles '
+                             '{:.2f}-{:.2f} deg. of the cross section '
+                             'table'.format(angular_region, *tabulated))
+        lo, hi = theta[idx[0]], theta[idx[-1]]
+        if idx[0] > 0:
+            lo = self._region_edge(lo, theta[idx[0] - 1], angular_region)
+        if idx[-1] < len(theta) - 1:
+            hi = self._region_edge(hi, theta[idx[-1] + 1], angular_region)
+        return lo, hi
+
+    def _table(self, angular_region):
+        key = tuple(angular_region)
+        table = self._tables.get(key)
+        if table is None:
+            theta = np.linspace(*self._region_angles(angular_region),
+                                num=self.n_points)
+            # cross sections fall exponentially, interpolate their logs
+            cs = np.exp(np.interp(theta, self.scattering_angles,
+                                  np.log(self.cross_section)))
+            pdf = cs * np.sin(np.radians(theta))
+            cdf = np.concatenate(([0.], np.cumsum(
+                0.5 * (pdf[1:] + pdf[:-1]) * np.diff(np.radians(theta)))))
+            if cdf[-1] <= 0:
+                raise ValueError('Cross section is zero in angular region '
+                                 '{}'.format(angular_region))
+            # integral over the region of dsigma/dOmega dOmega
+            total = 2 * np.pi * cdf[-1]
+            u = np.linspace(0., 1., self.n_points)
+            inverse_cdf = np.interp(u * cdf[-1], cdf, theta)
+            table = (self._lab_angles(inverse_cdf), total)
+            self._tables[key] = table
+        return table
+
+    def cross_section_in(self, angular_region):
+        """Returns cross section integrated over the lab angular region,
+        in units of dsigma/dOmega * sr."""
+        return self._table(angular_region)[1]
+
+    def sample(self, n_events, angular_region, rng=None):
+        """
+        Returns lab angles of n_events in deg.
+
+        param: angular_region - (min, max) lab angles of events
+        param: rng - np.random.Generator, if None global np.random state
+               is used
+        """
+        if rng is None:
+            rng = np.random
+        lab_of_u = self._table(angular_region)[0]
+        x = rng.uniform(0., 1., n_events) * (len(lab_of_u) - 1)
+        idx = np.minimum(x.astype(np.intp), len(lab_of_u) - 2)
+        return lab_of_u[idx] + (lab_of_u[idx + 1] - lab_of_u[idx]) * (x - idx)
@@ -0,0 +1,188 @@
+"""
+Particle identification by band cuts in dE-E plane.
+
+Band of a species is dE range between quantiles of its simulated events
+in each E bin. Bands are rasterized into an image of labels over (E, dE)
+plane, so an event is classified by one lookup of its pixel.
+"""
+
+import numpy as np
+
+from .histogram import E_RANGE, DE_RANGE
+
+
+# label of events outside of all bands
+UNIDENTIFIED = 0
+DEFAULT_CUT_BINS = 100
+DEFAULT_RASTER_BINS = 1000
+DEFAULT_QUANTILES = (0.01, 0.99)
+# min amount of events of a species in E bin to define its band there
+DEFAULT_MIN_EVENTS = 20
+
+
+class PIDCuts(object):
+    """
+    Band cuts of particle species & their label raster.
+
+    Labels of species are their indices in species list plus one,
+    UNIDENTIFIED is for events outside of all bands. Where bands overlap
+    the species with closer band center (relative to its width) wins.
+    """
+
+    def __init__(self, species, e_centers, de_low, de_high,
+                 e_range=E_RANGE, de_range=DE_RANGE,
+                 raster_bins=DEFAULT_RASTER_BINS):
+        """
+        param: species - list of particle IDs
+        param: e_centers - E values in MeV at which bands are defined
+        param: de_low, de_high - arrays (species, E values) of band edges
+               in MeV, NaN where a species has no band
+        param: e_range, de_range - (min, max) of the raster in MeV
+        param: raster_bins - amount of raster pixels, a number or
+               (E pixels, dE pixels)
+        """
+        self.species = list(species)
+        self.e_centers = np.asarray(e_centers, dtype=float)
+        self.de_low = np.asarray(de_low, dtype=float).reshape(
+            len(self.species), -1)
+        self.de_high = np.asarray(de_high, dtype=float).reshape(
+            len(self.species), -1)
+        self.e_range = tuple(e_range)
+        self.de_range = tuple(de_range)
+        e_bins, de_bins = (raster_bins, raster_bins) \
+            if np.ndim(raster_bins) == 0 else raster_bins
+        self.raster = np.zeros((e_bins, de_bins), dtype=np.uint8)
+        self.rasterize()
+
+    @classmethod
+    def from_results(cls, species, results, e_column='nai_e_loss',
+                     de_column='de', cut_bins=DEFAULT_CUT_BINS,
+                     quantiles=DEFAULT_QUANTILES,
+                     min_events=DEFAULT_MIN_EVENTS, **kwargs):
+        """
+        Builds bands from simulated events.
+
+        Particles not reaching E detector (E = 0) are not used.
+
+        param: species - particle ID of each results table, tables of the
+               same species are merged
+        param: results - list of tables of simulated events
+        param: cut_bins - amount of E bins in which bands are defined
+        param: quantiles - (low, high) quantiles of dE defining bands
+        param: min_events - min amount of events in E bin to define a band
+        param: kwargs - e_range, de_range & raster_bins of PIDCuts
+        """
+        e_range = kwargs.get('e_range', E_RANGE)
+        e_edges = np.linspace(e_range[0], e_range[1], cut_bins + 1)
+        names = []
+        for particle_id in species:
+            if particle_id not in names:
+                names.append(particle_id)
+        de_low = np.full((len(names), cut_bins), np.nan)
+        de_high = np.full((len(names), cut_bins), np.nan)
+        for i, name in enumerate(names):
+            e = np.concatenate([res[e_column].values for particle_id, res
+                                in zip(species, results)
+                                if particle_id == name])
+            de = np.concatenate([res[de_column].values for particle_id, res
+                                 in zip(species, results)
+                                 if particle_id == name])
+            reached = e > 0
+            e, de = e[reached], de[reached]
+            bin_idx = np.searchsorted(e_edges, e, side='right') - 1
+            # sort by bin to get each bin's events as one slice
+            order = np.argsort(bin_idx, kind='stable')
+            bin_idx, de = bin_idx[order], de[order]
+            bounds = np.searchsorted(bin_idx, np.arange(cut_bins + 1))
+            for j in range(cut_bins):
+                de_bin = de[bounds[j]:bounds[j + 1]]
+                if len(de_bin) >= min_events:
+                    de_low[i, j], de_high[i, j] = np.quantile(de_bin,
+                                                              quantiles)
+        e_centers = 0.5 * (e_edges[1:] + e_edges[:-1])
+        return cls(names, e_centers, de_low, de_high, **kwargs)
+
+    def _pixel_centers(self, value_range, n):
+        edges = np.linspace(value_range[0], value_range[1], n + 1)
+        return 0.5 * (edges[1:] + edges[:-1])
+
+    def rasterize(self):
+        """Fills label raster from band cuts."""
+        e_bins, de_bins = self.raster.shape
+        e = self._pixel_centers(self.e_range, e_bins)
+        de = self._pixel_centers(self.de_range, de_bins)
+        best_dist = np.full(self.raster.shape, np.inf)
+        self.raster[:] = UNIDENTIFIED
+        for i in range(len(self.species)):
+            # bands are linear between E values, pixels out of the E range
+            # of a band are not in it
+            defined = ~np.isnan(self.de_low[i])
+            if not np.any(defined):
+                continue
+            e_defined = self.e_centers[defined]
+            low = np.interp(e, e_defined, self.de_low[i][defined],
+                            left=np.nan, right=np.nan)
+            high = np.interp(e, e_defined, self.de_high[i][defined],
+                             left=np.nan, right=np.nan)
+            # gaps in a band are not filled
+            gap = np.interp(e, self.e_centers, (~defined).astype(float)) > 0
+            low[gap] = np.nan
+            center = 0.5 * (low + high)[:, None]
+            half_width = np.maximum(0.5 * (high - low), 1e-12)[:, None]
+            dist = np.abs(de[None, :] - center) / half_width
+            inside = dist <= 1.
+            closer = inside & (dist < best_dist)
+            self.raster[closer] = i + 1
+            best_dist[closer] = dist[closer]
+        return self.raster
+
+    def _pixel_indices(self, values, value_range, n):
+        idx = np.floor((values - value_range[0]) *
+                       (n / float(value_range[1] - value_range[0])))
+        return idx.astype(np.intp)
+
+    def classify(self, e, de):
+        """
+        Returns labels of events.
+
+        param: e - array of E in MeV
+        param: de - array of dE in MeV
+        """
+        e_bins, de_bins = self.raster.shape
+        e = np.asarray(e, dtype=float)
+        de = np.asarray(de, dtype=float)
+        ie = self._pixel_indices(e, self.e_range, e_bins)
+        ide = self._pixel_indices(de, self.de_range, de_bins)
+        inside = (ie >= 0) & (ie < e_bins) & (ide >= 0) & (ide < de_bins)
+        flat_idx = np.where(inside, ie * de_bins + ide, 0)
+        labels = np.where(inside, self.raster.reshape(-1)[flat_idx],
+                          self.raster.dtype.type(UNIDENTIFIED))
+        return labels if labels.ndim else labels.item()
+
+    def label_of(self, particle_id):
+        return self.species.index(particle_id) + 1
+
+    def species_of(self, labels):
+        """Returns particle IDs of labels, '' for unidentified events."""
+        return np.array([''] + self.species)[labels]
+
+    def save(self, path):
+        """Saves cuts & raster into compressed .npz file."""
+        np.savez_compressed(
+            path, species=np.array(self.species), e_centers=self.e_centers,
+            de_low=self.de_low, de_high=self.de_high,
+            e_range=self.e_range, de_range=self.de_range, raster=self.raster)
+
+    @classmethod
+    def load(cls, path):
+        """Loads cuts saved by save(), the raster is not recomputed."""
+        with np.load(path) as data:
+            cuts = cls.__new__(cls)
+            cuts.species = [str(s) for s in data['species']]
+            cuts.e_centers = data['e_centers']
+            cuts.de_low = data['de_low']
+            cuts.de_high = data['de_high']
+            cuts.e_range = tuple(data['e_range'])
+            cuts.de_range = tuple(data['de_range'])
+            cuts.raster = data['raster']
+        return cuts
@@ -0,0 +1,220 @@
+"""
+Reconstruction of incident energies & species from measured dE-E.
+
+Forward response of the dE-E telescope is computed once per species on a
+dense grid of incident energies, which gives a curve of (E, dE) points
+per species. The (E, dE) plane is rasterized into an inverse map holding
+the nearest curve point of each pixel (found with a KD-tree at build
+time), so an event is reconstructed by one pixel lookup and a projection
+onto the two curve segments around that point. Curves are double valued
+past the punch-through of the E detector, the nearest point handles
+both branches.
+"""
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+from . import timing
+from .histogram import E_RANGE, DE_RANGE
+from .pid import UNIDENTIFIED, DEFAULT_RASTER_BINS
+
+
+# incident energies of forward curves in MeV
+DEFAULT_RECO_E_MAX = 400.
+DEFAULT_RECO_N_POINTS = 4001
+# amount of pixels per chunk of brute force nearest point search
+BRUTE_FORCE_CHUNK = 1000
+
+
+class EnergyReconstructor(object):
+    """
+    Inverse of the dE-E telescope response.
+
+    Distances in (E, dE) plane are measured in units of the raster
+    ranges, so that both axes have the same weight, residuals of events
+    are their distances to the nearest curve in these units. Labels of
+    species are their indices in species list plus one, like in PIDCuts.
+    """
+
+    def __init__(self, de_detector, e_detector, species, degrader=None,
+                 e_max=DEFAULT_RECO_E_MAX, n_points=DEFAULT_RECO_N_POINTS,
+                 e_range=E_RANGE, de_range=DE_RANGE,
+                 raster_bins=DEFAULT_RASTER_BINS):
+        """
+        param: de_detector - dE detector (plastic) with a fixed thickness
+        param: e_detector - E detector (NaI) with a fixed thickness
+        param: species - list of particle IDs
+        param: degrader - WedgeEnergyDegrader in front of the telescope,
+               if given energies can be reconstructed at the target
+        param: e_max - max incident energy of curves in MeV
+        param: n_points - amount of points of each curve
+        param: e_range, de_range - (min, max) of the raster in MeV
+        param: raster_bins - amount of raster pixels, a number or
+               (E pixels, dE pixels)
+        """
+        self.de_detector = de_detector
+        self.e_detector = e_detector
+        self.species = list(species)
+        self.degrader = degrader
+        self.e_range = tuple(e_range)
+        self.de_range = tuple(de_range)
+        self._scale = np.array([1. / (e_range[1] - e_range[0]),
+                                1. / (de_range[1] - de_range[0])])
+        e0 = np.linspace(0., e_max, n_points)
+        # curves of all species one after another
+        self.curve_e0 = np.tile(e0, len(self.species))
+        self.curve_labels = np.repeat(
+            np.arange(1, len(self.species) + 1), n_points).astype(np.uint8)
+        points = [self.forward(particle_id, e0)
+                  for particle_id in self.species]
+        self.curve_e = np.concatenate([e for e, de in points])
+        self.curve_de = np.concatenate([de for e, de in points])
+        # whether a curve point is followed by a point of the same curve
+        self._has_next = np.ones(len(self.curve_e0), dtype=bool)
+        self._has_next[n_points - 1::n_points] = False
+        e_bins, de_bins = (raster_bins, raster_bins) \
+            if np.ndim(raster_bins) == 0 else raster_bins
+        self.raster = self._make_raster(e_bins, de_bins)
+
+    def forward(self, particle_id, e0):
+        """
+        Computes (E, dE) without resolution of particles entering the
+        dE detector with energies e0 in MeV.
+        """
+        de_stop_pow = self.de_detector._find_stop_pow(particle_id)
+        e_stop_pow = self.e_detector._find_stop_pow(particle_id)
+        de = de_stop_pow.e_loss(particle_id, e0, self.de_detector.thickness)
+        e = e_stop_pow.e_loss(particle_id, e0 - de,
+                              self.e_detector.thickness)
+        return e, de
+
+    def _normalized(self, e, de):
+        return np.stack([(e - self.e_range[0]) * self._scale[0],
+                         (de - self.de_range[0]) * self._scale[1]], axis=-1)
+
+    def _make_raster(self, e_bins, de_bins):
+        """Returns indices of curve points nearest to pixel centers."""
+        e_edges = np.linspace(0., 1., e_bins + 1)
+        de_edges = np.linspace(0., 1., de_bins + 1)
+        e_centers, de_centers = np.meshgrid(0.5 * (e_edges[1:] + e_edges[:-1]),
+                                            0.5 * (de_edges[1:] +
+                                                   de_edges[:-1]),
+                                            indexing='ij')
+        pixels = np.stack([e_centers.ravel(), de_centers.ravel()], axis=-1)
+        curve = self._normalized(self.curve_e, self.curve_de)
+        if HAVE_SCIPY:
+            # curves are thin, trees split at midpoints are much faster to
+            # query from pixels far from them
+            nearest = cKDTree(curve, balanced_tree=False,
+                              compact_nodes=False).query(pixels)[1]
+        else:
+            nearest = np.empty(len(pixels), dtype=np.intp)
+            for i in range(0, len(pixels), BRUTE_FORCE_CHUNK):
+                chunk = pixels[i:i + BRUTE_FORCE_CHUNK]
+                dist = ((chunk[:, None, :] - curve[None, :, :]) ** 2).sum(-1)
+                nearest[i:i + BRUTE_FORCE_CHUNK] = dist.argmin(axis=1)
+        return nearest.astype(np.int32).reshape(e_bins, de_bins)
+
+    def _pixel_indices(self, values, value_range, n):
+        idx = np.floor((values - value_range[0]) *
+                       (n / float(value_range[1] - value_range[0])))
+        return np.clip(idx, 0, n - 1).astype(np.intp)
+
+    def _project(self, a, x, y):
+        """Projects points onto curve segments starting at points a,
+        returns (fraction along segments, squared distances)."""
+        b = a + 1
+        ax = (self.curve_e[a] - self.e_range[0]) * self._scale[0]
+        ay = (self.curve_de[a] - self.de_range[0]) * self._scale[1]
+        dx = (self.curve_e[b] - self.e_range[0]) * self._scale[0] - ax
+        dy = (self.curve_de[b] - self.de_range[0]) * self._scale[1] - ay
+        length2 = dx * dx + dy * dy
+        t = ((x - ax) * dx + (y - ay) * dy) / np.where(length2 > 0,
+                                                       length2, 1.)
+        np.clip(t, 0., 1., out=t)
+        rx = x - ax - t * dx
+        ry = y - ay - t * dy
+        return t, rx * rx + ry * ry
+
+    def reconstruct(self, e, de, angles=None, max_residual=None):
+        """
+        Reconstructs incident energies, species & residuals of events.
+
+        param: e - array of measured E in MeV
+        param: de - array of measured dE in MeV
+        param: angles - scattering angles in deg., if given together with
+               a degrader, energies are reconstructed at the target
+               instead of at the dE detector
+        param: max_residual - events further from all curves are
+               UNIDENTIFIED with NaN energies
+        """
+        e = np.asarray(e, dtype=float)
+        de = np.asarray(de, dtype=float)
+        e_bins, de_bins = self.raster.shape
+        with timing.stage('reconstruction'):
+            nearest = self.raster[
+                self._pixel_indices(e, self.e_range, e_bins),
+                self._pixel_indices(de, self.de_range, de_bins)]
+            x = (e - self.e_range[0]) * self._scale[0]
+            y = (de - self.de_range[0]) * self._scale[1]
+            # segments before & after the nearest point, where the point
+            # has no neighbour the other segment is taken twice
+            last = len(self.curve_e0) - 1
+            has_before = (nearest > 0) & self._has_next[
+                np.maximum(nearest - 1, 0)]
+            before = np.where(has_before, nearest - 1, nearest)
+            after = np.where(self._has_next[nearest], nearest, before)
+            after = np.minimum(after, last - 1)
+            before = np.minimum(before, last - 1)
+            t_before, d_before = self._project(before, x, y)
+            t_after, d_after = self._project(after, x, y)
+            use_after = d_after < d_before
+            a = np.where(use_after, after, before)
+            t = np.where(use_after, t_after, t_before)
+            e0 = self.curve_e0[a] + t * (self.curve_e0[a + 1] -
+                                         self.curve_e0[a])
+            residual = np.sqrt(np.minimum(d_before, d_after))
+            labels = self.curve_labels[nearest]
+        if angles is not None and self.degrader is not None:
+            e0 = self.energy_before_degrader(labels, e0, angles)
+        if max_residual is not None:
+            rejected = residual > max_residual
+            labels = np.where(rejected, labels.dtype.type(UNIDENTIFIED),
+                              labels)
+            e0 = np.where(rejected, np.nan, e0)
+        return e0, labels, residual
+
+    def energy_before_degrader(self, labels, e_out, angles):
+        """
+        Computes energies in front of the degrader from energies after it.
+
+        param: labels - labels of species of events
+        param: e_out - energies after the degrader in MeV
+        param: angles - scattering angles in deg., one for each event or
+               one for all of them
+        """
+        d = self.degrader
+        # one angle can be given for all events
+        angles = np.broadcast_to(np.asarray(angles, dtype=float),
+                                 np.shape(e_out))
+        thickness = np.where(angles < d.base_angle, 0.,
+                             d.thickness_for(angles))
+        e_in = np.array(e_out, dtype=float)
+        for label, particle_id in enumerate(self.species, 1):
+            selected = labels == label
+            stop_pow = d._find_stop_pow(particle_id)
+            # range in front of the degrader is range after it plus its
+            # thickness
+            e_in[selected] = np.interp(
+                np.interp(e_out[selected], stop_pow._e, stop_pow._range) +
+                thickness[selected], stop_pow._range, stop_pow._e)
+        return e_in
+
+    def species_of(self, labels):
+        """Returns particle IDs of labels, '' for unidentified events."""
+        return np.array([''] + self.species)[labels]
@@ -0,0 +1,366 @@
+"""
+Precomputed detector responses.
+"""
+
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+from . import timing
+
+
+# energy grid of response tables in MeV
+DEFAULT_RESPONSE_E_MAX = 1000.
+DEFAULT_RESPONSE_N_POINTS = 10001
+# finer grid of response tables right above punch-through, where
+# energies of particles leaving the detector change fast
+DEFAULT_RESPONSE_FINE_E_MAX = 1.
+DEFAULT_RESPONSE_FINE_N_POINTS = 1001
+
+
+class ResponseTable(object):
+    """
+    Tabulated response of a detector of fixed thickness.
+
+    E-loss without resolution is computed once per particle on a grid of
+    incident energies above the punch-through energy, afterwards each
+    call is one grid lookup plus resolution smearing of the detector.
+    The grid is uniform with a finer step in the first fine_e_max MeV,
+    where e-losses bend sharply. Particles below the punch-through energy
+    stop inside, so the table has no steps inside. Tables do not depend
+    on what is in front of the detector, so they can be reused while e.g.
+    degrader is changed. Can be used in place of the detector in a
+    DetectorStack.
+    """
+
+    def __init__(self, detector, e_max=DEFAULT_RESPONSE_E_MAX,
+                 n_points=DEFAULT_RESPONSE_N_POINTS,
+                 fine_e_max=DEFAULT_RESPONSE_FINE_E_MAX,
+                 n_fine_points=DEFAULT_RESPONSE_FINE_N_POINTS):
+        """
+        param: detector - detector with a fixed thickness attribute
+        param: e_max - max tabulated energy above punch-through in MeV
+        param: n_points - amount of grid points from fine_e_max to e_max
+        param: fine_e_max - energy above punch-through in MeV up to which
+               the fine grid is used
+        param: n_fine_points - amount of points of the fine grid
+        """
+        self.detector = detector
+        self.e_max = e_max
+        self.fine_e_max = fine_e_max
+        self.e_above = np.concatenate((
+            np.linspace(0., fine_e_max, n_fine_points),
+            np.linspace(fine_e_max, e_max, n_points)[1:]))
+        # fractional grid index is energy above punch-through times scale
+        # plus offset, separately on both grids
+        self._fine_scale = (n_fine_points - 1) / float(fine_e_max)
+        self._scale = (n_points - 1) / float(e_max - fine_e_max)
+        self._offset = n_fine_points - 1 - fine_e_max * self._scale
+        # particle ID -> (punch-through energy, e-losses, slopes)
+        self.tables = {}
+        # particle ID -> (straggling sigmas, slopes) on the grid of tables
+        self.straggling_tables = {}
+
+    def _grid_energies(self, particle_id):
+        """Returns (punch-through energy, incident energies of the grid),
+        the first energy is the next float after the punch-through one,
+        so that the limit from above of the response step is tabulated."""
+        stop_pow = self.detector._find_stop_pow(particle_id)
+        e_punch_through = np.interp(self.detector.thickness,
+                                    stop_pow._range, stop_pow._e)
+        e = e_punch_through + self.e_above
+        e[0] = np.nextafter(e_punch_through, np.inf)
+        return e_punch_through, e
+
+    def table(self, particle_id):
+        """Returns (punch-through energy, e-losses, slopes) of a particle."""
+        table = self.tables.get(particle_id)
+        if table is None:
+            stop_pow = self.detector._find_stop_pow(particle_id)
+            e_punch_through, e = self._grid_energies(particle_id)
+            e_loss = stop_pow.e_loss(particle_id, e, self.detector.thickness)
+            table = (e_punch_through, e_loss, np.diff(e_loss))
+            self.tables[particle_id] = table
+        return table
+
+    def straggling_table(self, particle_id):
+        """Returns (straggling sigmas, slopes) of a particle on the grid."""
+        table = self.straggling_tables.get(particle_id)
+        if table is None:
+            stop_pow = self.detector._find_stop_pow(particle_id)
+            e = self._grid_energies(particle_id)[1]
+            sigmas = stop_pow.straggling_sigma(particle_id, e,
+                                               self.detector.thickness)
+            table = (sigmas, np.diff(sigmas))
+            self.straggling_tables[particle_id] = table
+        return table
+
+    def e_loss(self, particle_id, e, rng=None):
+        """
+        Computes e-loss inside the detector for a given particle type.
+
+        param: e - Energy of the incident particle, scalar or array
+        param particle_id - Name of the particle
+        param: rng - np.random.Generator used for resolution smearing
+        """
+        e_punch_through, e_loss_grid, slopes = self.table(particle_id)
+        e = np.asarray(e, dtype=float)
+        scalar = e.ndim == 0
+        if scalar:
+            e = e.reshape(1)
+        n_points = len(e_loss_grid)
+        with timing.stage('response_table'):
+            # fractional grid index, energies above the grid get the edge
+            # e-loss
+            w = e - e_punch_through
+            w = np.where(w < self.fine_e_max, w * self._fine_scale,
+                         w * self._scale + self._offset)
+            np.clip(w, 0, n_points - 1, out=w)
+            idx = w.astype(np.intp)
+            np.minimum(idx, n_points - 2, out=idx)
+            w -= idx
+            # particles below punch-through stop inside
+            stopped = e <= e_punch_through
+            e_loss = np.where(stopped, e, e_loss_grid[idx] + slopes[idx] * w)
+        if self.detector.straggling:
+            if rng is None:
+                rng = np.random
+            with timing.stage('straggling'):
+                sigmas, sigma_slopes = self.straggling_table(particle_id)
+                sigma = np.where(stopped, 0.,
+                                 sigmas[idx] + sigma_slopes[idx] * w)
+                e_loss = np.clip(e_loss + rng.normal(0, sigma), 0, e)
+        e_loss = e_loss + self.detector.get_resolution_error(e_loss, rng)
+        return e_loss.item() if scalar else e_loss
+
+    def layer_e_loss(self, particle_id, e, angles=None, rng=None):
+        return self.e_loss(particle_id, e, rng)
+
+
+# grid of wedge degrader response maps
+DEFAULT_MAP_ANGLE_POINTS = 501
+DEFAULT_MAP_E_POINTS = 4001
+# version of response maps format, bump it to invalidate cached maps
+RESPONSE_MAP_CACHE_VERSION = 1
+
+
+class WedgeResponseMap(object):
+    """
+    Tabulated response of a wedge energy degrader.
+
+    Energy after the degrader is computed once per particle on a uniform
+    grid of (scattering angle, incident energy above the punch-through
+    energy at this angle), afterwards each call is one bilinear
+    interpolation. The angular grid spans the part of the wedge which is
+    thicker than its min thickness, particles outside of it pass freely,
+    so the map has no steps inside. Maps are rebuilt when the degrader
+    geometry changes. Can be used in place of the degrader in a
+    DetectorStack.
+    """
+
+    def __init__(self, degrader, e_max=DEFAULT_RESPONSE_E_MAX,
+                 n_angles=DEFAULT_MAP_ANGLE_POINTS,
+                 n_energies=DEFAULT_MAP_E_POINTS, cache_dir=None):
+        """
+        param: degrader - WedgeEnergyDegrader
+        param: e_max - max tabulated energy above punch-through in MeV
+        param: n_angles, n_energies - amounts of grid points
+        param: cache_dir - if given, maps are kept there as .npy files
+               and are memory-mapped, e.g. to share them between runs
+               & worker processes
+        """
+        self.degrader = degrader
+        self.e_max = e_max
+        self.n_angles = n_angles
+        self.n_energies = n_energies
+        self.cache_dir = cache_dir
+        self.geometry = None
+        # particle ID -> map of energies after the degrader
+        self.maps = {}
+        # particle ID -> map of straggling sigmas
+        self.straggling_maps = {}
+        # particle ID -> punch-through energies on the angular grid
+        self.e_punch_through = {}
+
+    def degrader_geometry(self):
+        d = self.degrader
+        return (d.material_id, d.dist_from_target, d.base_angle, d.thickness,
+                d.min_thickness, d.length)
+
+    def _check_geometry(self):
+        geometry = self.degrader_geometry()
+        if geometry != self.geometry:
+            self.maps.clear()
+            self.straggling_maps.clear()
+            self.e_punch_through.clear()
+            self.geometry = geometry
+            self._make_angle_grid()
+
+    def _make_angle_grid(self):
+        """Angular grid from the degrader base to the angle where it gets
+        thinner than its min thickness."""
+        d = self.degrader
+        dist_cut = d.length * (1. - float(d.min_thickness) / d.thickness) \
+            if d.thickness > 0 else 0.
+        self.angle_min = d.base_angle
+        self.angle_max = d.base_angle + np.degrees(
+            2 * np.arctan(dist_cut / (2. * d.dist_from_target)))
+        self.angles = np.linspace(self.angle_min, self.angle_max,
+                                  self.n_angles)
+        self.thicknesses = d.thickness_at(d._compute_dist(
+            self.angles - d.base_angle, d.dist_from_target))
+        self.e_above = np.linspace(0., self.e_max, self.n_energies)
+
+    def _cache_file(self, particle_id, kind, stop_pow):
+        key = hashlib.sha1(repr((
+            RESPONSE_MAP_CACHE_VERSION, kind, particle_id, self.geometry,
+            self.e_max, self.n_angles, self.n_energies)).encode('utf-8'))
+        key.update(np.ascontiguousarray(stop_pow._e).tobytes())
+        key.update(np.ascontiguousarray(stop_pow._range).tobytes())
+        return os.path.join(self.cache_dir, '{}.{}.{}.npy'.format(
+            particle_id, kind, key.hexdigest()))
+
+    def _cached(self, particle_id, kind, make_map):
+        """Returns map made by make_map(stop_pow) through the cache."""
+        stop_pow = self.degrader._find_stop_pow(particle_id)
+        if self.cache_dir is None:
+            return make_map(stop_pow)
+        cache_file = self._cache_file(particle_id, kind, stop_pow)
+        if not os.path.isfile(cache_file):
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir,
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp:
+                np.save(tmp, make_map(stop_pow))
+            os.rename(tmp_file, cache_file)
+        return np.load(cache_file, mmap_mode='r')
+
+    def punch_through(self, particle_id):
+        """Returns punch-through energies of a particle on angular grid."""
+        self._check_geometry()
+        e_pt = self.e_punch_through.get(particle_id)
+        if e_pt is None:
+            stop_pow = self.degrader._find_stop_pow(particle_id)
+            e_pt = np.interp(self.thicknesses, stop_pow._range, stop_pow._e)
+            self.e_punch_through[particle_id] = e_pt
+        return e_pt
+
+    def _incident_energies(self, particle_id):
+        return (self.punch_through(particle_id)[:, None] +
+                self.e_above[None, :])
+
+    def map(self, particle_id):
+        """Returns map of energies after the degrader of a particle."""
+        self._check_geometry()
+        e_map = self.maps.get(particle_id)
+        if e_map is None:
+            def make_map(stop_pow):
+                e = self._incident_energies(particle_id)
+                e_map = e - stop_pow.e_loss(particle_id, e,
+                                            self.thicknesses[:, None])
+                # limit from above of the step at punch-through, stopping
+                # powers start at a finite energy
+                e_map[:, 0] = stop_pow._e[0]
+                return e_map
+            e_map = self._cached(particle_id, 'e', make_map)
+            self.maps[particle_id] = e_map
+        return e_map
+
+    def straggling_map(self, particle_id):
+        """Returns map of straggling sigmas of a particle."""
+        self._check_geometry()
+        sigma_map = self.straggling_maps.get(particle_id)
+        if sigma_map is None:
+            def make_map(stop_pow):
+                e = self._incident_energies(particle_id)
+                return stop_pow.straggling_sigma(particle_id, e,
+                                                 self.thicknesses[:, None])
+            sigma_map = self._cached(particle_id, 'straggling', make_map)
+            self.straggling_maps[particle_id] = sigma_map
+        return sigma_map
+
+    def e_loss(self, particle_id, e, scattering_angle, rng=None):
+        """
+        Computes e-loss inside the degrader for a given particle type.
+
+        param: e - Energy of the incident particle, scalar or array
+        param particle_id - Name of the particle
+        param: scattering_angle - Scattering angle(s) in deg.
+        param: rng - np.random.Generator to sample straggling from
+        """
+        e_map = self.map(particle_id)
+        e_pt_grid = self.punch_through(particle_id)
+        e, angles = np.broadcast_arrays(np.asarray(e, dtype=float),
+                                        np.asarray(scattering_angle,
+                                                   dtype=float))
+        scalar = e.ndim == 0
+        if scalar:
+            e, angles = e.reshape(1), angles.reshape(1)
+        n_angles, n_energies = e_map.shape
+        with timing.stage('response_map'):
+            # fractional grid indices & weights, computed in place as
+            # this is the per-event path
+            wa = angles - self.angle_min
+            if self.angle_max > self.angle_min:
+                wa *= (n_angles - 1) / (self.angle_max - self.angle_min)
+            np.clip(wa, 0, n_angles - 1, out=wa)
+            ia = wa.astype(np.intp)
+            np.minimum(ia, n_angles - 2, out=ia)
+            wa -= ia
+            e_pt = e_pt_grid[ia + 1]
+            e_pt -= e_pt_grid[ia]
+            e_pt *= wa
+            e_pt += e_pt_grid[ia]
+            we = e - e_pt
+            we *= (n_energies - 1) / self.e_max
+            np.clip(we, 0, n_energies - 1, out=we)
+            idx = we.astype(np.intp)
+            np.minimum(idx, n_energies - 2, out=idx)
+            we -= idx
+            idx += ia * n_energies
+            e_loss = e - self._bilinear(e_map, idx, wa, we)
+            # particles below punch-through stop inside, ones passing by
+            # the degrader do not lose energy
+            stopped = e <= e_pt
+            e_loss = np.where(stopped, e, e_loss)
+            outside = (angles < self.angle_min) | (angles > self.angle_max)
+            e_loss[outside] = 0.
+        if self.degrader.straggling:
+            if rng is None:
+                rng = np.random
+            with timing.stage('straggling'):
+                sigma = self._bilinear(self.straggling_map(particle_id),
+                                       idx, wa, we)
+                sigma[outside | stopped] = 0.
+                e_loss = np.clip(e_loss + rng.normal(0, sigma), 0, e)
+        return e_loss.item() if scalar else e_loss
+
+    @staticmethod
+    def _bilinear(grid_map, idx, wa, we):
+        """Interpolates map at flat indices of lower corners of cells."""
+        flat = grid_map.reshape(-1)
+        row = grid_map.shape[1]
+        lower = flat[idx]
+        tmp = flat[idx + 1]
+        tmp -= lower
+        tmp *= we
+        lower += tmp
+        upper = flat[idx + row]
+        tmp = flat[idx + row + 1]
+        tmp -= upper
+        tmp *= we
+        upper += tmp
+        upper -= lower
+        upper *= wa
+        lower += upper
+        return lower
+
+    def layer_e_loss(self, particle_id, e, angles=None, rng=None):
+        return self.e_loss(particle_id, e, angles, rng)
+
+    def layer_scattering(self, particle_id, e_in, e_out, angles, rng=None):
+        return self.degrader.layer_scattering(particle_id, e_in, e_out,
+                                              angles, rng)
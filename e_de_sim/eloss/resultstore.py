@@ -0,0 +1,210 @@
+"""
+Chunked columnar store of simulation results.
+
+A run is a directory with meta.json (run parameters, seed, chunks index)
+and one sub-directory per reaction holding result chunks:
+ - npy: one .npy file per column of a chunk, they can be memory-mapped
+ - parquet: one .parquet file per chunk (needs pyarrow)
+ - hdf5: one .h5 file per chunk (needs PyTables)
+"""
+
+import os
+import glob
+import json
+import tempfile
+from os.path import join, isdir
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    HAVE_PARQUET = True
+except ImportError:
+    HAVE_PARQUET = False
+
+try:
+    import tables
+    HAVE_HDF5 = True
+except ImportError:
+    HAVE_HDF5 = False
+
+
+META_FILE = 'meta.json'
+FORMATS = ('npy', 'parquet', 'hdf5')
+
+
+def _write_json(path, obj):
+    """Writes JSON file atomically, readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def _to_json(value):
+    """Converts numpy values in run parameters to plain python ones."""
+    if isinstance(value, dict):
+        return dict((k, _to_json(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ResultStore(object):
+    """
+    Writer & reader of chunked simulation results.
+
+    Use ResultStore.create() to start a new run and ResultStore.open()
+    to read an existing one.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    @classmethod
+    def create(cls, path, params=None, seed=None, fmt='npy'):
+        """
+        Creates a new run directory.
+
+        param: path - run directory, should not exist or be empty
+        param: params - dict of run parameters stored as metadata
+        param: seed - seed of the run stored as metadata
+        param: fmt - chunks format, one of FORMATS
+        """
+        if fmt not in FORMATS:
+            raise ValueError('Unknown results format: "{}", known are: {}'
+                             .format(fmt, FORMATS))
+        if fmt == 'parquet' and not HAVE_PARQUET:
+            raise ValueError('parquet format needs pyarrow to be installed')
+        if fmt == 'hdf5' and not HAVE_HDF5:
+            raise ValueError('hdf5 format needs PyTables to be installed')
+        if isdir(path) and os.listdir(path):
+            raise ValueError('Results directory "{}" is not empty'
+                             .format(path))
+        if not isdir(path):
+            os.makedirs(path)
+        meta = {'format': fmt, 'params': _to_json(params or {}),
+                'seed': _to_json(seed), 'columns': None,
+                'reactions': [], 'chunks': {}}
+        store = cls(path, meta)
+        store._write_meta()
+        return store
+
+    @classmethod
+    def open(cls, path):
+        """Opens an existing run directory for reading."""
+        with open(join(path, META_FILE)) as f:
+            return cls(path, json.load(f))
+
+    @property
+    def params(self):
+        return self.meta['params']
+
+    @property
+    def seed(self):
+        return self.meta['seed']
+
+    @property
+    def reactions(self):
+        return list(self.meta['reactions'])
+
+    @property
+    def columns(self):
+        return self.meta['columns']
+
+    def __len__(self):
+        """Total amount of stored events."""
+        return sum(sum(chunks) for chunks in self.meta['chunks'].values())
+
+    def set_meta(self, **kwargs):
+        """Updates run metadata, e.g. seed known only after a run starts."""
+        for k, v in kwargs.items():
+            self.meta[k] = _to_json(v)
+        self._write_meta()
+
+    def _write_meta(self):
+        _write_json(join(self.path, META_FILE), self.meta)
+
+    def _chunk_path(self, reaction, idx):
+        return join(self.path, reaction, '{:06d}'.format(idx))
+
+    def append(self, reaction, df):
+        """
+        Writes a chunk of results of a reaction.
+
+        param: reaction - name of the reaction, used as directory name
+        param: df - DataFrame with a chunk of results
+        """
+        if self.meta['columns'] is None:
+            self.meta['columns'] = list(df.columns)
+        elif list(df.columns) != self.meta['columns']:
+            raise ValueError('Chunk columns {} do not match run columns {}'
+                             .format(list(df.columns), self.meta['columns']))
+        if reaction not in self.meta['reactions']:
+            self.meta['reactions'].append(reaction)
+            self.meta['chunks'][reaction] = []
+            os.makedirs(join(self.path, reaction))
+        chunk_path = self._chunk_path(reaction,
+                                      len(self.meta['chunks'][reaction]))
+        fmt = self.meta['format']
+        if fmt == 'npy':
+            for col in df.columns:
+                np.save('{}.{}.npy'.format(chunk_path, col), df[col].values)
+        elif fmt == 'parquet':
+            df.to_parquet(chunk_path + '.parquet')
+        elif fmt == 'hdf5':
+            df.to_hdf(chunk_path + '.h5', key='results', mode='w')
+        self.meta['chunks'][reaction].append(len(df))
+        self._write_meta()
+
+    def truncate(self, n_chunks):
+        """
+        Drops chunks written after a point of the run, e.g. after the last
+        checkpoint of a run which is resumed.
+
+        param: n_chunks - dict reaction name -> amount of chunks to keep
+        """
+        for reaction, chunks in self.meta['chunks'].items():
+            n = n_chunks.get(reaction, 0)
+            for idx in range(n, len(chunks)):
+                for path in glob.glob(self._chunk_path(reaction, idx) + '.*'):
+                    os.remove(path)
+            del chunks[n:]
+        self._write_meta()
+
+    def read_chunk(self, reaction, idx, columns=None, mmap=True):
+        """
+        Reads one chunk of results of a reaction.
+
+        param: columns - list of columns to read, all by default
+        param: mmap - memory-map columns instead of reading them (npy only)
+        """
+        columns = columns or self.meta['columns']
+        chunk_path = self._chunk_path(reaction, idx)
+        fmt = self.meta['format']
+        if fmt == 'npy':
+            mmap_mode = 'r' if mmap else None
+            return pd.DataFrame(
+                dict((col, np.load('{}.{}.npy'.format(chunk_path, col),
+                                   mmap_mode=mmap_mode))
+                     for col in columns), columns=columns, copy=False)
+        elif fmt == 'parquet':
+            return pd.read_parquet(chunk_path + '.parquet', columns=columns)
+        elif fmt == 'hdf5':
+            return pd.read_hdf(chunk_path + '.h5', 'results')[columns]
+
+    def iter_chunks(self, reaction, columns=None, mmap=True):
+        """Yields chunks of results of a reaction one by one."""
+        for idx in range(len(self.meta['chunks'].get(reaction, []))):
+            yield self.read_chunk(reaction, idx, columns, mmap)
+
+    def read(self, reaction, columns=None):
+        """Reads all results of a reaction into one DataFrame."""
+        chunks = list(self.iter_chunks(reaction, columns, mmap=False))
+        if not chunks:
+            return pd.DataFrame(columns=columns or self.meta['columns'])
+        return pd.concat(chunks, ignore_index=True)
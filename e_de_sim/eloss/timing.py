@@ -0,0 +1,114 @@
+"""
+Optional timing of simulation stages.
+
+Code of a stage is wrapped into "with stage(name):", it is timed only
+while a StageTimer is activated by profiling(). Otherwise stage() returns
+a shared no-op context, so instrumented code costs one function call per
+batch of events.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    __slots__ = ('stats', 'start')
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats[0] += timer() - self.start
+        self.stats[1] += 1
+        return False
+
+
+class StageTimer(object):
+    """Cumulative wall time and amount of calls per stage."""
+
+    def __init__(self):
+        # stage name -> [seconds, calls], in order of first call
+        self.stats = OrderedDict()
+
+    def stage(self, name):
+        """Returns context which adds its time to the stage."""
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0., 0]
+        return _Stage(stats)
+
+    def reset(self):
+        self.stats.clear()
+
+    def merge(self, other):
+        """Adds stats of another timer, e.g. of a worker process."""
+        for name, (seconds, calls) in other.stats.items():
+            stats = self.stats.setdefault(name, [0., 0])
+            stats[0] += seconds
+            stats[1] += calls
+        return self
+
+    def summary(self, total_stage=None):
+        """
+        Returns table of stages as a string.
+
+        param: total_stage - name of the stage to compute shares of
+               other stages from, e.g. the whole run
+        """
+        total = self.stats[total_stage][0] \
+            if total_stage in self.stats else None
+        lines = ['{:20} {:>8} {:>11} {:>12} {:>7}'.format(
+            'stage', 'calls', 'total, s', 'per call, ms', '%')]
+        for name, (seconds, calls) in self.stats.items():
+            share = '{:.1f}'.format(100. * seconds / total) \
+                if total else '-'
+            lines.append('{:20} {:>8} {:>11.4f} {:>12.4f} {:>7}'.format(
+                name, calls, seconds, 1e3 * seconds / max(calls, 1), share))
+        return '\n'.join(lines)
+
+
+_active_timer = None
+
+
+def stage(name):
+    """Returns context timing a stage with the active timer, no-op if
+    profiling is not active."""
+    if _active_timer is None:
+        return NULL_STAGE
+    return _active_timer.stage(name)
+
+
+@contextmanager
+def profiling(stage_timer=None):
+    """
+    Activates a timer for stages run inside of the context.
+
+    param: stage_timer - StageTimer to collect into, a new one if None
+    """
+    global _active_timer
+    if stage_timer is None:
+        stage_timer = StageTimer()
+    previous_timer = _active_timer
+    _active_timer = stage_timer
+    try:
+        yield stage_timer
+    finally:
+        _active_timer = previous_timer
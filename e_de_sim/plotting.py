@@ -0,0 +1,121 @@
+"""
+Plots of e-dE simulation results.
+
+Figures are rendered with the non-interactive Agg backend straight into
+files, so plotting works headless and in worker processes. Simulation
+code does not import this module, batch runs do not load matplotlib.
+"""
+
+import multiprocessing as mp
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+from eloss.histogram import Hist2D, E_RANGE, DE_RANGE, fill_e_de_hist
+
+# import seaborn as sns
+# sns.set_context("poster")
+FIGURE_SIZE = (8, 6)
+
+
+class EspriEdESimResultsPlotter:
+
+    def __init__(self, reaction_kinematics_data, results, name="",
+                 hist=None):
+        """
+        param: hist - accumulated E vs dE Hist2D, if None the histogram
+               is filled from results
+        """
+        self.results = results
+        self.reaction_kinematics_data = reaction_kinematics_data
+        self.name = name
+        self.hist = hist
+
+    def _save(self, fig, file_name):
+        fig.tight_layout()
+        fig.savefig(file_name)
+        # figures are closed explicitly, pyplot keeps them otherwise
+        plt.close(fig)
+
+    def plot_e_de(self):
+        fig, ax = plt.subplots(figsize=FIGURE_SIZE)
+        for (kin, res) in \
+            zip(self.reaction_kinematics_data, self.results):
+            # ax.scatter(res['nai_e_loss'], res['de'], label=kin.particle_id,
+            #            marker=markers[i])
+            ax.plot(res['nai_e_loss'], res['de'],
+                    label=kin.particle_id, marker='.', markersize=8,
+                    linestyle="")
+        ax.grid()
+        ax.set_title('E vs. dE ({})'.format(self.name))
+        ax.set_xlabel('E [MeV]')
+        ax.set_ylabel('dE [MeV]')
+        ax.set_ylim(0, 37)
+        ax.set_xlim(0, 220)
+        ax.legend()
+        self._save(fig, 'e_de({}).png'.format(self.name))
+
+    def plot_e_de_hist(self):
+        fig, ax = plt.subplots(figsize=FIGURE_SIZE)
+        hist = self.hist
+        if hist is None:
+            hist = Hist2D(E_RANGE, DE_RANGE)
+            for res in self.results:
+                fill_e_de_hist(hist, res)
+        mesh = ax.pcolormesh(hist.x_edges, hist.y_edges,
+                             np.ma.masked_equal(hist.counts.T, 0),
+                             norm=LogNorm())
+        fig.colorbar(mesh, ax=ax)
+        ax.grid()
+        ax.set_title('E vs. dE ({})'.format(self.name))
+        ax.set_xlabel('E [MeV]')
+        ax.set_ylabel('dE [MeV]')
+        ax.set_ylim(0, 37)
+        ax.set_xlim(0, 220)
+        self._save(fig, 'e_de_hist({}).png'.format(self.name))
+
+    def plot_e_aft_deg(self):
+        fig, ax = plt.subplots(figsize=FIGURE_SIZE)
+        for (kin, res) in \
+            zip(self.reaction_kinematics_data, self.results):
+            ax.plot(res['angle'], res['tke'] - res['e_deg_e_loss'],
+                    label=kin.particle_id)
+        ax.grid()
+        ax.set_title('E vs. angle ({})'.format(self.name))
+        ax.set_xlabel('Angle deg.')
+        ax.set_ylabel('E [MeV]')
+        ax.set_ylim(0, 200)
+        ax.set_xlim(53, 73)
+        ax.legend()
+        self._save(fig, 'e_aft_deg({}).png'.format(self.name))
+
+    def plot_all(self):
+        self.plot_e_aft_deg()
+        self.plot_e_de()
+        self.plot_e_de_hist()
+
+
+def _render(plotter):
+    plotter.plot_all()
+    return plotter.name
+
+
+def render_plots(plotters, n_workers=None):
+    """
+    Renders all figures of plotters, e.g. one per sweep point.
+
+    param: plotters - list of EspriEdESimResultsPlotter
+    param: n_workers - amount of worker processes, if None - amount of
+           CPUs, if 1 - figures are rendered in this process
+    """
+    if n_workers == 1 or len(plotters) < 2:
+        return [_render(plotter) for plotter in plotters]
+    pool = mp.Pool(processes=n_workers)
+    try:
+        return pool.map(_render, plotters, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
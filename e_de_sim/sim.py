@@ -14,16 +14,20 @@ how we can carry out PID of protons from background reaction on carbon in
 target material.
 """
 
+import os
+import copy
+import itertools
+import multiprocessing as mp
+
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
 
 from eloss.ede import *
 from eloss.detectors import *
-
-# import seaborn as sns
-# sns.set_context("poster")
-plt.figure(figsize=(8, 6))
+from eloss.histogram import Hist2D, fill_e_de_hist
+from eloss.response import ResponseTable, WedgeResponseMap
+from eloss.pid import PIDCuts
+from eloss.checkpoint import Checkpoint
+from eloss import timing
 
 
 ### Simulation parameters
@@ -34,7 +38,8 @@ DEGRADER_DIST_FROM_TARGET = 1070.
 # angle at which degrader starts, its base is located at at this point
 # e.g. in case of wedge degrader it is where the thickest part is
 DEGRADER_BASE_ANGLE = 53.0
-
+# amount of events per reaction processed in one shard of a parallel run
+DEFAULT_SHARD_SIZE = 100000
 
 
 ### Scattering kinematics data
@@ -42,60 +47,57 @@ RECOIL_P_KIN = ReactionKinematics(
     PROTON_ID, 'data/Recoil proton kin for 6He(p,p)6He.csv')
 RECOIL_P_KIN_DET_LOSS = ReactionKinematics(
     PROTON_ID, 'data/recoil_proton_energies_det_loss.csv')
-SCATT_D_KIN = ReactionKinematics(
-    DEUTERON_ID, 'data/Deuteron kin for d(C, C)d.csv')
 # To compute e losses we want total kin-e not MeV/u
-SCATT_D_KIN.kin_data['e'] = SCATT_D_KIN.kin_data['e'] * 2
+SCATT_D_KIN = ReactionKinematics(
+    DEUTERON_ID, 'data/Deuteron kin for d(C, C)d.csv', e_scale=2)
 
 
 ### Simulation of de & e in espri
 
-class RandomDeuteronKinematics(object):
+class RandomKinematics(Kinematics):
+    """
+    Energies uniformly distributed in a range of MeV/u, no angle dependence.
+    """
 
-    def __init__(self, e_range):
+    def __init__(self, particle_id, e_range, nucleons=1):
         """
         param: particle_id - name of a particle for which this kinematics is
+        param: e_range - [min, max] energy in MeV/u
+        param: nucleons - amount of nucleons in the particle
         """
-        self.particle_id = DEUTERON_ID
+        super(RandomKinematics, self).__init__(particle_id)
         self.e_range = e_range
-
-    def __getitem__(self, angle):
-        """Returns energy as a function of angle."""
-        # just a uniform distribution, no angle dependence, MeV/u
-        e = np.random.uniform(self.e_range[0], self.e_range[1], 1)[0] * 2
+        self.nucleons = nucleons
+
+    def sample(self, angles, rng=None):
+        """Returns energies for given angles drawn from rng."""
+        if rng is None:
+            rng = np.random
+        # one energy per angle, scalar angle gives a scalar energy
+        e = rng.uniform(self.e_range[0], self.e_range[1],
+                        np.shape(angles) or None) * self.nucleons
         return e
 
 
-class RandomTritiumKinematics(object):
+class RandomDeuteronKinematics(RandomKinematics):
 
     def __init__(self, e_range):
-        """
-        param: particle_id - name of a particle for which this kinematics is
-        """
-        self.particle_id = TRITIUM_ID
-        self.e_range = e_range
-
-    def __getitem__(self, angle):
-        """Returns energy as a function of angle."""
-        # just a uniform distribution, no angle dependence, MeV/u
-        e = np.random.uniform(self.e_range[0], self.e_range[1], 1)[0] * 3
-        return e
+        super(RandomDeuteronKinematics, self).__init__(
+            DEUTERON_ID, e_range, 2)
 
 
-class RandomProtonKinematics(object):
+class RandomTritiumKinematics(RandomKinematics):
 
     def __init__(self, e_range):
-        """
-        param: particle_id - name of a particle for which this kinematics is
-        """
-        self.particle_id = PROTON_ID
-        self.e_range = e_range
+        super(RandomTritiumKinematics, self).__init__(
+            TRITIUM_ID, e_range, 3)
 
-    def __getitem__(self, angle):
-        """Returns energy as a function of angle."""
-        # just a uniform distribution, no angle dependence, MeV/u
-        e = np.random.uniform(self.e_range[0], self.e_range[1], 1)[0] * 1
-        return e
+
+class RandomProtonKinematics(RandomKinematics):
+
+    def __init__(self, e_range):
+        super(RandomProtonKinematics, self).__init__(
+            PROTON_ID, e_range, 1)
 
 
 class EspriEdESim(object):
@@ -104,140 +106,751 @@ class EspriEdESim(object):
     """
 
     def __init__(self, angular_region, reaction_kinematics_data = [],
-                 e_degrader_thickness=25.):
+                 e_degrader_thickness=25.,
+                 degrader_base_angle=DEGRADER_BASE_ANGLE,
+                 degrader_dist_from_target=DEGRADER_DIST_FROM_TARGET,
+                 degrader_min_thickness=2., degrader_length=220.,
+                 straggling=False, multiple_scattering=False,
+                 degrader_response_map=False, response_map_dir=None,
+                 profile=False):
         ### Angular region where to compute E-dE
         self.angular_region = angular_region
         ### Detectors
         self.espri_plastic = EspriPlastic(BC400_ID)
         self.espri_nai = EspriNaI(NAI_ID)
         self.espri_e_degrader = WedgeEnergyDegrader(
-            BRASS_ID, DEGRADER_DIST_FROM_TARGET,
-            DEGRADER_BASE_ANGLE, e_degrader_thickness, 2., 220.)
+            BRASS_ID, degrader_dist_from_target,
+            degrader_base_angle, e_degrader_thickness,
+            degrader_min_thickness, degrader_length)
         self.enable_e_degrader = True
+        ### Energy straggling in all detectors & multiple scattering in
+        ### the degrader, angles after it are in "angle_out" column
+        for detector in (self.espri_plastic, self.espri_nai,
+                         self.espri_e_degrader):
+            detector.straggling = straggling
+        self.espri_e_degrader.multiple_scattering = multiple_scattering
+        # layer name -> object used in place of the detector in the stack,
+        # e.g. a ResponseTable
+        self.layer_responses = {}
+        ### Degrader response precomputed on (angle, energy) grid, maps are
+        ### memory-mapped from response_map_dir if it is given
+        if degrader_response_map:
+            self.layer_responses['e_deg_e_loss'] = WedgeResponseMap(
+                self.espri_e_degrader, cache_dir=response_map_dir)
         ### Scattering kinematics data
         self.reaction_kinematics_data = reaction_kinematics_data
         ### outputs store
         self.results = []
+        ### SeedSequence entropy of the last run, None if it is unknown
+        self.seed = None
+        ### timing of simulation stages, if profile is on it is collected
+        ### into self.timer during run() & run_sharded() and printed in
+        ### the end
+        self.profile = profile
+        self.timer = timing.StageTimer()
         ### private vars
 
-    def do_reaction(self, react_kin, angle_step=0.001):
-        df = pd.DataFrame(
-            columns=['angle', 'tke', 'e_deg_e_loss', 'de', 'nai_e_loss',
-                     'e_residual'])
-        dfidx = 0
-        angle = ANGULAR_REGION[0]
-
-        while angle < ANGULAR_REGION[1]:
-            tke = react_kin[angle]
-            # print 'angle: {}; TKE: {}'.format(angle, tke)
-
-            if self.enable_e_degrader:
-                e_deg_e_loss = self.espri_e_degrader.e_loss(
-                    react_kin.particle_id, tke, angle)
-                e_minus_e_deg = tke - e_deg_e_loss
-            else:
-                e_deg_e_loss = 0.
-                e_minus_e_deg = tke
-
-            de = self.espri_plastic.e_loss(
-                react_kin.particle_id, e_minus_e_deg)
-            e_minus_de = e_minus_e_deg - de
-            if e_minus_de < 0:
-                e_minus_de = 0
-            e_loss_in_nai = self.espri_nai.e_loss(
-                react_kin.particle_id, e_minus_de)
-            e_residual = e_minus_de - e_loss_in_nai
-            # print ('\te_deg_e-loss: {}; de: {}; nai_e-loss: {}; '
-            #        'e-residual: {}'.format(
-            #            e_deg_e_loss, de, e_loss_in_nai, e_residual))
-
-            df.loc[dfidx] = [angle, tke, e_deg_e_loss, de, e_loss_in_nai,
-                             e_residual]
-
-            angle += angle_step
-            dfidx += 1
-        return df
-
-    def run(self):
+    def params(self):
+        """Returns parameters of this simulation, e.g. for run metadata."""
+        reactions = []
+        for kin in self.reaction_kinematics_data:
+            reaction = {'particle_id': kin.particle_id,
+                        'kinematics': type(kin).__name__}
+            if hasattr(kin, 'e_range'):
+                reaction['e_range'] = list(kin.e_range)
+            if hasattr(kin, 'beam_energy'):
+                reaction['reaction'] = str(kin)
+            reactions.append(reaction)
+        return {'angular_region': list(self.angular_region),
+                'e_degrader_thickness': self.espri_e_degrader.thickness,
+                'degrader_base_angle': self.espri_e_degrader.base_angle,
+                'degrader_dist_from_target':
+                    self.espri_e_degrader.dist_from_target,
+                'degrader_min_thickness': self.espri_e_degrader.min_thickness,
+                'degrader_length': self.espri_e_degrader.length,
+                'enable_e_degrader': self.enable_e_degrader,
+                'straggling': self.espri_nai.straggling,
+                'multiple_scattering':
+                    self.espri_e_degrader.multiple_scattering,
+                'degrader_response_map':
+                    'e_deg_e_loss' in self.layer_responses,
+                'reactions': reactions}
+
+    def reaction_names(self):
+        """Names of reactions in result stores: <index>_<particle ID>."""
+        return ['{}_{}'.format(i, kin.particle_id)
+                for i, kin in enumerate(self.reaction_kinematics_data)]
+
+    def detector_stack(self):
+        """Returns detectors as a stack of layers named by results columns."""
+        layers = [('de', self.espri_plastic),
+                  ('nai_e_loss', self.espri_nai)]
+        if self.enable_e_degrader:
+            layers.insert(0, ('e_deg_e_loss', self.espri_e_degrader))
+        return DetectorStack([(name, self.layer_responses.get(name, detector))
+                              for name, detector in layers])
+
+    def load_stopping_powers(self):
+        """
+        Resolves stopping powers of all detectors for all reactions.
+
+        Useful to load them once before forking worker processes.
+        """
         for reaction in self.reaction_kinematics_data:
-            res = self.do_reaction(reaction)
+            for detector in (self.espri_e_degrader, self.espri_plastic,
+                             self.espri_nai):
+                detector._find_stop_pow(reaction.particle_id)
+
+    def pid_cuts(self, **kwargs):
+        """
+        Builds PID band cuts from results of the last run.
+
+        param: kwargs - see PIDCuts.from_results()
+        """
+        species = [kin.particle_id for kin in self.reaction_kinematics_data]
+        return PIDCuts.from_results(species, self.results[-len(species):],
+                                    **kwargs)
+
+    def make_angles(self, n_events=None, angle_step=0.001, rng=None,
+                    angular_distribution=None):
+        """
+        Makes an array of scattering angles inside of the angular region.
+
+        param: n_events - amount of angles to sample in the angular region,
+               if None region is scanned with angle_step
+        param: angle_step - step of the angular scan in deg.
+        param: rng - np.random.Generator to sample angles from, if None
+               global np.random state is used
+        param: angular_distribution - AngularDistribution to sample angles
+               from, if None they are uniform
+        """
+        if n_events is None:
+            return np.arange(self.angular_region[0], self.angular_region[1],
+                             angle_step)
+        if angular_distribution is not None:
+            return angular_distribution.sample(n_events, self.angular_region,
+                                               rng)
+        if rng is None:
+            rng = np.random
+        return rng.uniform(self.angular_region[0],
+                           self.angular_region[1], n_events)
+
+    def do_reaction(self, react_kin, angles=None, n_events=None,
+                    angle_step=0.001, rng=None):
+        """
+        Computes E & dE for a batch of events of the given reaction.
+
+        All events are processed at once as array operations and results
+        table is built in the end.
+
+        param: react_kin - kinematics of the reaction product
+        param: angles - array of scattering angles in deg., if None
+               they are made by make_angles(), sampled from the angular
+               distribution of the kinematics if it has one
+        param: n_events - amount of events to sample when angles are None
+        param: angle_step - step of the angular scan when angles and
+               n_events are None
+        param: rng - np.random.Generator for event sampling & detector
+               resolutions, if None global np.random state is used
+        """
+        if angles is None:
+            angles = self.make_angles(
+                n_events, angle_step, rng,
+                getattr(react_kin, 'angular_distribution', None))
+        angles = np.asarray(angles, dtype=float)
+        with timing.stage('kinematics'):
+            tke = np.asarray(react_kin.sample(angles, rng), dtype=float)
+
+        deposits, e_residual, angles_out = self.detector_stack().transport(
+            react_kin.particle_id, tke, angles, rng, return_angles=True)
+        with timing.stage('assembly'):
+            e_deg_e_loss = deposits.get('e_deg_e_loss', np.zeros_like(tke))
+            de = deposits['de']
+            e_loss_in_nai = deposits['nai_e_loss']
+
+            columns = ['angle', 'tke', 'e_deg_e_loss', 'de', 'nai_e_loss',
+                       'e_residual']
+            if self.espri_e_degrader.multiple_scattering:
+                columns.append('angle_out')
+            return pd.DataFrame(
+                {'angle': angles, 'tke': tke, 'e_deg_e_loss': e_deg_e_loss,
+                 'de': de, 'nai_e_loss': e_loss_in_nai,
+                 'e_residual': e_residual, 'angle_out': angles_out},
+                columns=columns)
+
+    def run(self, n_events=None, rng=None, hist=None, store=None,
+            seed=None):
+        """
+        Runs all reactions.
+
+        Entropy of the SeedSequence of the run is kept in self.seed and
+        in the store metadata, together with the spawn key for generators
+        spawned from another sequence.
+
+        param: n_events - amount of events to sample per reaction, if None
+               the whole angular region is scanned
+        param: rng - np.random.Generator for event sampling & detector
+               resolutions, if None a generator is made from seed when
+               seed or store is given, otherwise global np.random state
+               is used
+        param: hist - Hist2D to fill with E (NaI) vs dE (plastic) of events
+        param: store - ResultStore to write results of reactions into
+        param: seed - seed of the generator made when rng is None, if
+               None fresh entropy is used
+        """
+        if rng is None and (seed is not None or store is not None):
+            rng = np.random.default_rng(np.random.SeedSequence(seed))
+        if not self.profile:
+            return self._run(n_events, rng, hist, store)
+        self.timer.reset()
+        with timing.profiling(self.timer):
+            with self.timer.stage('run'):
+                self._run(n_events, rng, hist, store)
+        print(self.timer.summary('run'))
+        return self.results
+
+    def _run(self, n_events, rng, hist, store):
+        seed_seq = _seed_sequence(rng)
+        self.seed = seed_seq.entropy if seed_seq is not None else None
+        if store is not None:
+            params = self.params()
+            params.update(n_events=n_events)
+            store.set_meta(params=params, seed=self.seed)
+            if seed_seq is not None and seed_seq.spawn_key:
+                store.set_meta(spawn_key=seed_seq.spawn_key)
+        for name, reaction in zip(self.reaction_names(),
+                                  self.reaction_kinematics_data):
+            res = self.do_reaction(reaction, n_events=n_events, rng=rng)
+            if hist is not None:
+                with timing.stage('histogram'):
+                    fill_e_de_hist(hist, res)
+            if store is not None:
+                with timing.stage('store'):
+                    store.append(name, res)
             self.results.append(res)
         return self.results
 
+    def run_sharded(self, n_events, seed=None, n_workers=None,
+                    shard_size=DEFAULT_SHARD_SIZE, hist=None,
+                    keep_events=True, store=None, checkpoint=None,
+                    checkpoint_every=1):
+        """
+        Runs all reactions splitting events into shards over a process pool.
+
+        Shards depend only on n_events & shard_size and each of them gets
+        its own generator spawned from SeedSequence(seed). Shard outputs
+        are merged in shard order, so that the same seed gives identical
+        results for any amount of workers.
+
+        With a checkpoint file the run saves its state after every
+        checkpoint_every shards. If the file exists the run is resumed
+        after its last shard and gives the same histogram & stored results
+        as an uninterrupted one. Events are not saved in checkpoints, with
+        keep_events the results of a resumed run are read from the store.
+
+        param: n_events - amount of events to sample per reaction
+        param: seed - seed of the run, if None fresh entropy is used
+        param: n_workers - amount of worker processes, if None - amount
+               of CPUs, if 1 - shards are run in this process
+        param: shard_size - amount of events per reaction in one shard
+        param: hist - Hist2D to fill with E vs dE, each shard fills its own
+               copy which are merged into this one
+        param: keep_events - if False events are not kept in results and
+               only hist and store are filled, memory then does not
+               depend on n_events
+        param: store - ResultStore to write shards into as chunks, run
+               parameters and seed are written to its metadata. To resume
+               a run pass its store opened by ResultStore.open()
+        param: checkpoint - path of the checkpoint file
+        param: checkpoint_every - amount of shards between checkpoints
+
+        With profile on, stage timers of shards are merged into self.timer
+        and printed in the end. Shards run in parallel, so their stages
+        may take more than 100% of the run time.
+        """
+        args = (n_events, seed, n_workers, shard_size, hist, keep_events,
+                store, checkpoint, checkpoint_every)
+        if not self.profile:
+            return self._run_sharded(*args)
+        self.timer.reset()
+        with timing.profiling(self.timer):
+            with self.timer.stage('run'):
+                self._run_sharded(*args)
+        print(self.timer.summary('run'))
+        return self.results
 
-class EspriEdESimResultsPlotter:
+    def _run_sharded(self, n_events, seed, n_workers, shard_size, hist,
+                     keep_events, store, checkpoint, checkpoint_every):
+        params = self.params()
+        params.update(n_events=n_events, shard_size=shard_size)
+        state = None
+        if checkpoint is not None:
+            if keep_events and store is None:
+                raise ValueError('Checkpoints do not keep events, run with '
+                                 'a store or with keep_events=False')
+            if os.path.isfile(checkpoint):
+                state = Checkpoint.load(checkpoint)
+                state.check_params(params)
+                if seed is not None and \
+                        np.random.SeedSequence(seed).entropy != state.seed:
+                    raise ValueError('Seed differs from the checkpoint one')
+                seed = state.seed
+                if hist is not None:
+                    if state.hist_counts is None:
+                        raise ValueError('Checkpoint has no histogram')
+                    saved_hist = hist.empty_copy()
+                    saved_hist.counts[:] = state.hist_counts
+                    saved_hist.entries = state.hist_entries
+                    hist.merge(saved_hist)
+                if store is not None:
+                    # drop chunks written after the checkpoint
+                    store.truncate(state.store_chunks or {})
+        seed_seq = np.random.SeedSequence(seed)
+        self.seed = seed_seq.entropy
+        if store is not None:
+            store.set_meta(params=params, seed=self.seed)
+        n_shards = max(1, -(-n_events // shard_size))
+        shard_sizes = [min(shard_size, n_events - i * shard_size)
+                       for i in range(n_shards)]
+        if checkpoint is not None and state is None:
+            # a run killed before its first checkpoint is resumed from the
+            # start with chunks it wrote dropped
+            state = Checkpoint(params, self.seed)
+            self._save_checkpoint(state, checkpoint, 0, shard_sizes, hist,
+                                  store)
+        first_shard = state.next_shard if state is not None else 0
+        shards = list(zip(shard_sizes, seed_seq.spawn(n_shards)))[
+            first_shard:]
+        worker_args = (self, hist.empty_copy() if hist is not None else None,
+                       keep_events or store is not None)
+
+        reactions_results = [[] for r in self.reaction_kinematics_data]
+        pool = None
+        if n_workers == 1:
+            _init_shard_worker(*worker_args)
+            shard_outputs = (_run_shard(shard) for shard in shards)
+        else:
+            pool = mp.Pool(processes=n_workers,
+                           initializer=_init_shard_worker,
+                           initargs=worker_args)
+            shard_outputs = pool.imap(_run_shard, shards, chunksize=1)
+        try:
+            for shard_idx, (shard_results, shard_hist,
+                            shard_timer) in enumerate(shard_outputs,
+                                                      first_shard + 1):
+                if shard_timer is not None:
+                    self.timer.merge(shard_timer)
+                if hist is not None:
+                    hist.merge(shard_hist)
+                if store is not None:
+                    for name, res in zip(self.reaction_names(),
+                                         shard_results):
+                        store.append(name, res)
+                if keep_events and checkpoint is None:
+                    for res, reaction_results in zip(shard_results,
+                                                     reactions_results):
+                        reaction_results.append(res)
+                if state is not None and (shard_idx % checkpoint_every == 0
+                                          or shard_idx == n_shards):
+                    self._save_checkpoint(state, checkpoint, shard_idx,
+                                          shard_sizes, hist, store)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if keep_events and checkpoint is not None:
+            for name in self.reaction_names():
+                self.results.append(store.read(name))
+        elif keep_events:
+            for reaction_results in reactions_results:
+                self.results.append(pd.concat(reaction_results,
+                                              ignore_index=True))
+        return self.results
 
-    def __init__(self, reaction_kinematics_data, results, name=""):
-        self.results = results
-        self.reaction_kinematics_data = reaction_kinematics_data
-        self.name = name
-
-    def plot_e_de(self):
-        plt.figure()
-        for (kin, res) in \
-            zip(self.reaction_kinematics_data, self.results):
-            # plt.scatter(res['nai_e_loss'], res['de'], label=kin.particle_id,
-            #             marker=markers[i])
-            plt.plot(res['nai_e_loss'], res['de'],
-                     label=kin.particle_id, marker='.', markersize=8,
-                     linestyle="")
-        plt.grid()
-        plt.title('E vs. dE ({})'.format(self.name))
-        plt.xlabel('E [MeV]')
-        plt.ylabel('dE [MeV]')
-        plt.ylim(0, 37)
-        plt.xlim(0, 220)
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig('e_de({}).png'.format(
-            self.name))
-        # plt.show()
-
-    def plot_e_de_hist(self):
-        plt.figure()
-        hist_df = None
-        for (kin, res) in \
-            zip(self.reaction_kinematics_data, self.results):
-            if hist_df is None:
-                hist_df = res.copy()
-            else:
-                hist_df = hist_df.append(res)
-        plt.hist2d(hist_df['nai_e_loss'], hist_df['de'], bins=120,
-                   range=np.array([(0, 200), (0, 37)]), norm=LogNorm())
-        plt.colorbar()
-        plt.grid()
-        plt.title('E vs. dE ({})'.format(self.name))
-        plt.xlabel('E [MeV]')
-        plt.ylabel('dE [MeV]')
-        plt.ylim(0, 37)
-        plt.xlim(0, 220)
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig('e_de_hist({}).png'.format(
-            self.name))
-        # plt.show()
-
-    def plot_e_aft_deg(self):
-        plt.figure()
-        for (kin, res) in \
-            zip(self.reaction_kinematics_data, self.results):
-            plt.plot(res['angle'], res['tke'] - res['e_deg_e_loss'],
-                     label=kin.particle_id)
-        plt.grid()
-        plt.title('E vs. angle ({})'.format(self.name))
-        plt.xlabel('Angle deg.')
-        plt.ylabel('E [MeV]')
-        plt.ylim(0, 200)
-        plt.xlim(53, 73)
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig('e_aft_deg({}).png'.format(
-            self.name))
-        # plt.show()
+    def _save_checkpoint(self, state, path, next_shard, shard_sizes, hist,
+                         store):
+        state.next_shard = next_shard
+        n_events = sum(shard_sizes[:next_shard])
+        state.events = dict((name, n_events)
+                            for name in self.reaction_names())
+        if store is not None:
+            state.store_chunks = dict(
+                (name, len(store.meta['chunks'].get(name, [])))
+                for name in self.reaction_names())
+        if hist is not None:
+            state.hist_counts = hist.counts
+            state.hist_entries = hist.entries
+        with timing.stage('checkpoint'):
+            state.save(path)
+
+
+def _seed_sequence(rng):
+    """Returns SeedSequence of a generator, None for global np.random
+    state or generators without one."""
+    bit_generator = getattr(rng, 'bit_generator', None)
+    # public since numpy 1.25
+    seed_seq = getattr(bit_generator, 'seed_seq',
+                       getattr(bit_generator, '_seed_seq', None))
+    return seed_seq if isinstance(seed_seq, np.random.SeedSequence) \
+        else None
+
+
+### Workers of sharded runs
+
+
+_shard_sim = None
+_shard_hist = None
+_shard_keep_events = True
+
+
+def _init_shard_worker(sim, hist=None, keep_events=True):
+    global _shard_sim, _shard_hist, _shard_keep_events
+    _shard_sim = sim
+    _shard_hist = hist
+    _shard_keep_events = keep_events
+
+
+def _run_shard(shard):
+    """Runs one shard: (n_events, seed_seq) of the worker's simulation.
+
+    Returns results of each reaction (empty if events are not kept),
+    histogram of the shard (None if no histogram is filled) and its stage
+    timer (None if profile of the simulation is off)."""
+    if not _shard_sim.profile:
+        return _run_shard_events(shard) + (None,)
+    with timing.profiling() as stage_timer:
+        return _run_shard_events(shard) + (stage_timer,)
+
+
+def _run_shard_events(shard):
+    n_events, seed_seq = shard
+    rng = np.random.default_rng(seed_seq)
+    hist = _shard_hist.empty_copy() if _shard_hist is not None else None
+    results = []
+    for reaction in _shard_sim.reaction_kinematics_data:
+        res = _shard_sim.do_reaction(reaction, n_events=n_events, rng=rng)
+        if hist is not None:
+            with timing.stage('histogram'):
+                fill_e_de_hist(hist, res)
+        if _shard_keep_events:
+            results.append(res)
+    return results, hist
+
+
+### Parameter sweeps
+
+
+# parameters of EspriEdESim which can be swept
+SIM_SWEEP_PARAMETERS = ('e_degrader_thickness', 'degrader_base_angle',
+                        'degrader_dist_from_target', 'degrader_min_thickness',
+                        'degrader_length', 'straggling', 'multiple_scattering')
+# parameters of reaction kinematics which can be swept, they set e_range
+# of kinematics having it
+KINEMATICS_SWEEP_PARAMETERS = ('e_min', 'e_max')
+SWEEP_PARAMETERS = SIM_SWEEP_PARAMETERS + KINEMATICS_SWEEP_PARAMETERS
+
+
+def sweep_grid(**axes):
+    """
+    Returns sweep points for all combinations of given parameter values.
+
+    E.g. sweep_grid(e_degrader_thickness=[40, 60], degrader_base_angle=[53.])
+    """
+    unknown = set(axes) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown sweep parameters: {}'.format(
+            sorted(unknown)))
+    names = [name for name in SWEEP_PARAMETERS if name in axes]
+    return [dict(zip(names, values))
+            for values in itertools.product(*[axes[n] for n in names])]
+
+
+def make_sweep_sim(angular_region, reaction_kinematics_data, point,
+                   **sim_options):
+    """
+    Makes EspriEdESim for a sweep point.
+
+    param: point - dict of parameter values, missing ones take defaults
+    param: sim_options - other keyword arguments of EspriEdESim
+    """
+    kinematics = []
+    for kin in reaction_kinematics_data:
+        if hasattr(kin, 'e_range') and \
+           any(p in point for p in KINEMATICS_SWEEP_PARAMETERS):
+            kin = copy.copy(kin)
+            kin.e_range = [point.get('e_min', kin.e_range[0]),
+                           point.get('e_max', kin.e_range[1])]
+        kinematics.append(kin)
+    sim_params = dict((p, point[p]) for p in SIM_SWEEP_PARAMETERS
+                      if p in point)
+    sim_params.update(sim_options)
+    return EspriEdESim(angular_region, kinematics, **sim_params)
+
+
+def run_sweep(angular_region, reaction_kinematics_data, points,
+              n_events=None, seed=None, n_workers=None, sim_options=None):
+    """
+    Runs simulation for each sweep point in parallel.
+
+    Stopping powers & kinematics tables are loaded once and shared by all
+    points through worker initialization, each point gets its own
+    generator spawned from SeedSequence(seed).
+
+    param: angular_region - angular region of all points
+    param: reaction_kinematics_data - reactions simulated at each point
+    param: points - list of dicts with values of SWEEP_PARAMETERS,
+           e.g. made by sweep_grid()
+    param: n_events - events per reaction per point, if None the angular
+           region is scanned
+    param: seed - seed of the sweep, if None fresh entropy is used
+    param: n_workers - amount of worker processes, if None - amount of
+           CPUs, if 1 - points are run in this process
+    param: sim_options - dict of other EspriEdESim arguments of all points,
+           e.g. degrader_response_map & response_map_dir to share degrader
+           maps of points with the same geometry
+    Returns results of all points in one table indexed by the swept
+    parameters, reaction name (see EspriEdESim.reaction_names()) & event
+    number.
+    """
+    if not points:
+        raise ValueError('Sweep needs at least one point')
+    names = [name for name in SWEEP_PARAMETERS
+             if any(name in point for point in points)]
+    for point in points:
+        if set(point) != set(names):
+            raise ValueError('All sweep points should set the same '
+                             'parameters: {}'.format(names))
+    sim_options = sim_options or {}
+    first_sim = make_sweep_sim(angular_region, reaction_kinematics_data,
+                               points[0], **sim_options)
+    first_sim.load_stopping_powers()
+    for kin in reaction_kinematics_data:
+        kin.load()
+    worker_args = (angular_region, reaction_kinematics_data, sim_options)
+
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(points))
+    tasks = [(point, n_events, seed_seq)
+             for point, seed_seq in zip(points, seed_seqs)]
+    if n_workers == 1:
+        _init_sweep_worker(*worker_args)
+        points_results = [_run_sweep_point(task) for task in tasks]
+    else:
+        pool = mp.Pool(processes=n_workers, initializer=_init_sweep_worker,
+                       initargs=worker_args)
+        try:
+            points_results = pool.map(_run_sweep_point, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    frames, keys = [], []
+    for point, point_results in zip(points, points_results):
+        for name, res in zip(first_sim.reaction_names(), point_results):
+            frames.append(res)
+            keys.append(tuple(point[n] for n in names) + (name,))
+    return pd.concat(frames, keys=keys,
+                     names=names + ['reaction', 'event'])
+
+
+_sweep_args = None
+
+
+def _init_sweep_worker(angular_region, reaction_kinematics_data,
+                       sim_options):
+    global _sweep_args
+    _sweep_args = (angular_region, reaction_kinematics_data, sim_options)
+
+
+def _run_sweep_point(task):
+    point, n_events, seed_seq = task
+    angular_region, reaction_kinematics_data, sim_options = _sweep_args
+    sim = make_sweep_sim(angular_region, reaction_kinematics_data, point,
+                         **sim_options)
+    return sim.run(n_events=n_events, rng=np.random.default_rng(seed_seq))
+
+
+### Degrader geometry optimization
+
+
+# search space of the degrader geometry: parameter -> (min, max)
+DEFAULT_DEGRADER_BOUNDS = {
+    'e_degrader_thickness': (10., 200.),
+    'degrader_min_thickness': (0., 10.),
+    'degrader_length': (100., 300.),
+    'degrader_base_angle': (50., 56.),
+}
+
+
+def separation_fom(signal_hist, background_hist, n_signal, n_background):
+    """
+    Figure of merit of signal vs background separation in dE-E plane.
+
+    It is the signal detection efficiency weighted by signal purity of each
+    bin: sum(s * s / (s + b)), where s & b are fractions of thrown signal
+    & background events in a bin. Particles not reaching the NaI (first E
+    bin) are not identified and do not count. FOM is within [0, 1].
+
+    param: signal_hist, background_hist - Hist2D of signal & background
+    param: n_signal, n_background - amounts of thrown events
+    """
+    s = signal_hist.counts[1:] / float(n_signal)
+    b = background_hist.counts[1:] / float(n_background)
+    total = s + b
+    nonzero = total > 0
+    return float(np.sum(s[nonzero] ** 2 / total[nonzero]))
+
+
+class DegraderOptimizer(object):
+    """
+    Searches degrader geometry giving the best separation of signal (e.g.
+    protons) from background (e.g. deuterons & tritons) in dE-E plane.
+
+    Plastic & NaI responses are tabulated once and reused by all
+    evaluations, candidates are evaluated in parallel. All evaluations
+    use the same seed, so candidates are compared on the same events.
+    """
+
+    def __init__(self, angular_region, signal_kinematics,
+                 background_kinematics, bounds=DEFAULT_DEGRADER_BOUNDS,
+                 n_events=100000, seed=0, n_workers=None):
+        """
+        param: angular_region - angular region of the simulation
+        param: signal_kinematics - list of kinematics of signal reactions
+        param: background_kinematics - list of kinematics of background
+        param: bounds - dict of searched parameters -> (min, max), see
+               DEFAULT_DEGRADER_BOUNDS, other sweep parameters can be fixed
+               by equal min & max
+        param: n_events - amount of events per reaction in one evaluation
+        param: seed - seed of events of every evaluation & of the search
+        param: n_workers - amount of worker processes, if None - amount
+               of CPUs, if 1 - candidates are evaluated in this process
+        """
+        unknown = set(bounds) - set(SIM_SWEEP_PARAMETERS)
+        if unknown:
+            raise ValueError('Unknown degrader parameters: {}'.format(
+                sorted(unknown)))
+        self.angular_region = angular_region
+        self.signal_kinematics = list(signal_kinematics)
+        self.background_kinematics = list(background_kinematics)
+        self.bounds = dict(bounds)
+        self.n_events = n_events
+        self.seed = seed
+        self.n_workers = n_workers
+        self.layer_responses = None
+        # evaluated points with their figures of merit
+        self.history = []
+
+    def _make_sim(self, point):
+        sim = make_sweep_sim(
+            self.angular_region,
+            self.signal_kinematics + self.background_kinematics, point)
+        sim.layer_responses = self.layer_responses
+        return sim
+
+    def load_responses(self):
+        """Tabulates responses of plastic & NaI for all particles."""
+        if self.layer_responses is None:
+            sim = make_sweep_sim(
+                self.angular_region,
+                self.signal_kinematics + self.background_kinematics, {})
+            sim.load_stopping_powers()
+            self.layer_responses = {
+                'de': ResponseTable(sim.espri_plastic),
+                'nai_e_loss': ResponseTable(sim.espri_nai)}
+            for kin in sim.reaction_kinematics_data:
+                for table in self.layer_responses.values():
+                    table.table(kin.particle_id)
+        return self.layer_responses
+
+    def evaluate_point(self, point):
+        """Returns figure of merit of one degrader geometry."""
+        sim = self._make_sim(point)
+        rng = np.random.default_rng(self.seed)
+        n_signal = len(self.signal_kinematics)
+        signal_hist, background_hist = Hist2D(), Hist2D()
+        for i, kin in enumerate(sim.reaction_kinematics_data):
+            res = sim.do_reaction(kin, n_events=self.n_events, rng=rng)
+            fill_e_de_hist(signal_hist if i < n_signal else background_hist,
+                           res)
+        return separation_fom(
+            signal_hist, background_hist, n_signal * self.n_events,
+            (len(sim.reaction_kinematics_data) - n_signal) * self.n_events)
+
+    def evaluate(self, points):
+        """Returns figures of merit of degrader geometries, in parallel."""
+        self.load_responses()
+        if self.n_workers == 1:
+            foms = [self.evaluate_point(point) for point in points]
+        else:
+            pool = mp.Pool(processes=self.n_workers,
+                           initializer=_init_optimizer_worker,
+                           initargs=(self,))
+            try:
+                foms = pool.map(_evaluate_degrader, points)
+            finally:
+                pool.close()
+                pool.join()
+        self.history.extend(zip(points, foms))
+        return foms
+
+    def _sample_points(self, rng, n_points, center=None, scale=1.):
+        """Samples points uniformly in bounds or in a box around center
+        shrunk by scale."""
+        points = [{} for i in range(n_points)]
+        for name in sorted(self.bounds):
+            lo, hi = self.bounds[name]
+            if center is not None:
+                half_width = (hi - lo) * scale / 2.
+                lo = max(lo, center[name] - half_width)
+                hi = min(hi, center[name] + half_width)
+            for point, value in zip(points, rng.uniform(lo, hi, n_points)):
+                point[name] = value
+        return points
+
+    def optimize(self, n_candidates=32, n_rounds=4, shrink=0.5):
+        """
+        Runs random search with a zoom around the best point.
+
+        First round samples candidates in the whole bounds, each next one
+        samples them around the best point so far in a box shrunk by
+        shrink factor.
+
+        param: n_candidates - amount of candidates per round
+        param: n_rounds - amount of rounds
+        param: shrink - box shrink factor between rounds
+        Returns table of evaluated points sorted by figure of merit.
+        """
+        rng = np.random.default_rng(self.seed)
+        best, scale = None, 1.
+        for i in range(n_rounds):
+            points = self._sample_points(rng, n_candidates, best, scale)
+            self.evaluate(points)
+            best = max(self.history, key=lambda h: h[1])[0]
+            scale *= shrink
+        return self.results()
+
+    def results(self):
+        """Returns table of evaluated points sorted by figure of merit."""
+        df = pd.DataFrame([point for point, fom in self.history])
+        df['fom'] = [fom for point, fom in self.history]
+        return df.sort_values('fom', ascending=False).reset_index(drop=True)
+
+
+_optimizer = None
+
+
+def _init_optimizer_worker(optimizer):
+    global _optimizer
+    _optimizer = optimizer
+
+
+def _evaluate_degrader(point):
+    return _optimizer.evaluate_point(point)
 
 
 if __name__ == '__main__':
-    print "### ESPRI dE-E simulation ###"
+    print("### ESPRI dE-E simulation ###")
     # angular region of interest in lab deg.
     ANGULAR_REGION = (55., 70.)
     rand_deuteron_kin = RandomDeuteronKinematics([10., 200.])
@@ -248,21 +861,20 @@ if __name__ == '__main__':
                          e_degrader_thickness=0)
     bg_sim.run()
 
-    for t in [40, 60, 80, 100, 140, 180]:
-        rand_proton_kin = RandomProtonKinematics([20, t])
-        sim = EspriEdESim(ANGULAR_REGION,
-                          [rand_proton_kin],
-                          e_degrader_thickness=t)
-        sim.run()
-
-        results_plotter = EspriEdESimResultsPlotter(
-            bg_sim.reaction_kinematics_data, bg_sim.results,
-            "E(p) = 20 - {}".format(t))
-        results_plotter.reaction_kinematics_data.append(
-            sim.reaction_kinematics_data[0])
-        results_plotter.results.append(sim.results[0])
-        results_plotter.plot_e_aft_deg()
-        results_plotter.plot_e_de()
-        results_plotter.plot_e_de_hist()
-        del results_plotter.reaction_kinematics_data[-1]
-        del results_plotter.results[-1]
+    # proton energies go up to the degrader thickness
+    rand_proton_kin = RandomProtonKinematics([20, 40])
+    sweep_results = run_sweep(
+        ANGULAR_REGION, [rand_proton_kin],
+        [{'e_degrader_thickness': t, 'e_max': t}
+         for t in [40, 60, 80, 100, 140, 180]])
+
+    # plotting is imported only here, simulations do not need matplotlib
+    from plotting import EspriEdESimResultsPlotter, render_plots
+    plotters = []
+    for (t, e_max), res in sweep_results.groupby(
+            level=['e_degrader_thickness', 'e_max']):
+        plotters.append(EspriEdESimResultsPlotter(
+            bg_sim.reaction_kinematics_data + [rand_proton_kin],
+            bg_sim.results + [res.reset_index(drop=True)],
+            "E(p) = 20 - {}".format(t)))
+    render_plots(plotters)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of the simulation are imported as top level ones, like in sim.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
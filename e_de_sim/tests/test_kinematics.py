@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from eloss.ede import PROTON_ID
+from eloss.kinematics import TwoBodyKinematics, AngularDistribution, HE6_ID
+
+
+def make_distribution(scattering_angles):
+    kinematics = TwoBodyKinematics(HE6_ID, PROTON_ID, PROTON_ID, 200.)
+    return AngularDistribution(kinematics, scattering_angles,
+                               np.exp(-scattering_angles / 20.))
+
+
+def test_sampled_angles_in_region():
+    distribution = make_distribution(np.linspace(0., 180., 400))
+    angles = distribution.sample(100000, (55., 70.),
+                                 np.random.default_rng(0))
+    assert angles.min() >= 55.
+    assert angles.max() <= 70.
+
+
+def test_region_past_tabulated_angles():
+    # recoil protons of these scattering angles are at about 58-89 deg.
+    distribution = make_distribution(np.linspace(2., 56., 200))
+    with pytest.raises(ValueError):
+        distribution.cross_section_in((55., 70.))
+    with pytest.raises(ValueError):
+        distribution.sample(10, (60., 89.5))
+    assert distribution.cross_section_in((60., 70.)) > 0
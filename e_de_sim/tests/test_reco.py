@@ -0,0 +1,23 @@
+import numpy as np
+
+from eloss.ede import PROTON_ID, DEUTERON_ID, BC400_ID, NAI_ID, BRASS_ID
+from eloss.detectors import EspriPlastic, EspriNaI, WedgeEnergyDegrader
+from eloss.reco import EnergyReconstructor
+
+
+def make_reconstructor():
+    degrader = WedgeEnergyDegrader(BRASS_ID, dist_from_target=200.,
+                                   base_angle=55., thickness=20.)
+    return EnergyReconstructor(EspriPlastic(BC400_ID), EspriNaI(NAI_ID),
+                               [PROTON_ID, DEUTERON_ID], degrader=degrader,
+                               raster_bins=200)
+
+
+def test_scalar_angle_of_all_events():
+    reco = make_reconstructor()
+    e = np.array([50., 80., 120.])
+    de = np.array([6., 4., 3.])
+    e0, labels, residual = reco.reconstruct(e, de, angles=60.)
+    e0_each = reco.reconstruct(e, de, angles=np.full(len(e), 60.))[0]
+    assert np.allclose(e0, e0_each)
+    assert np.all(e0 > reco.reconstruct(e, de)[0])
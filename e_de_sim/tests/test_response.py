@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from eloss.ede import PROTON_ID, DEUTERON_ID, TRITIUM_ID, BRASS_ID, \
+    BC400_ID, NAI_ID
+from eloss.detectors import WedgeEnergyDegrader, EspriPlastic, EspriNaI
+from eloss.response import ResponseTable, WedgeResponseMap
+
+
+def make_degrader(thickness):
+    degrader = WedgeEnergyDegrader(BRASS_ID, dist_from_target=200.,
+                                   base_angle=55., thickness=thickness)
+    degrader.straggling = True
+    return degrader
+
+
+@pytest.mark.parametrize('thickness', [20., 60.])
+def test_wedge_map_straggling_matches_degrader(thickness):
+    degrader = make_degrader(thickness)
+    response_map = WedgeResponseMap(degrader)
+    rng = np.random.default_rng(0)
+    n = 200000
+    e = rng.uniform(20., 200., n)
+    angles = rng.uniform(55., 70., n)
+    direct = degrader.e_loss(PROTON_ID, e, angles,
+                             rng=np.random.default_rng(1))
+    tabulated = response_map.e_loss(PROTON_ID, e, angles,
+                                    rng=np.random.default_rng(2))
+    assert abs(direct.mean() - tabulated.mean()) < 0.05
+    assert abs(direct.std() - tabulated.std()) < 0.05
+    # particles stopping without straggling lose all of their energy
+    degrader.straggling = False
+    stopped = degrader.e_loss(PROTON_ID, e, angles) >= e
+    assert np.all(tabulated[stopped] == e[stopped])
+    q = np.linspace(0.01, 0.99, 99)
+    assert np.max(np.abs(np.quantile(direct, q) -
+                         np.quantile(tabulated, q))) < 0.5
+
+
+@pytest.mark.parametrize('detector_class, material_id', [
+    (EspriPlastic, BC400_ID), (EspriNaI, NAI_ID)])
+def test_response_table_matches_detector(detector_class, material_id):
+    detector = detector_class(material_id)
+    detector.resolution_sigma = 0.
+    table = ResponseTable(detector)
+    for particle_id in (PROTON_ID, DEUTERON_ID, TRITIUM_ID):
+        e_punch_through = table.table(particle_id)[0]
+        stop_pow = detector._find_stop_pow(particle_id)
+        # dense near punch-through, where e-losses bend sharply
+        e = np.concatenate([
+            e_punch_through + np.linspace(-1., 1., 100001),
+            np.linspace(0., 500., 100001)])
+        # the step at punch-through may move by rounding of ranges
+        e = e[np.abs(e - e_punch_through) > 1e-6]
+        expected = stop_pow.e_loss(particle_id, e, detector.thickness)
+        assert np.max(np.abs(table.e_loss(particle_id, e) -
+                             expected)) < 0.03
@@ -0,0 +1,27 @@
+import numpy as np
+
+import sim
+from eloss.resultstore import ResultStore
+
+
+def make_sim():
+    return sim.EspriEdESim((55., 70.),
+                           [sim.RandomProtonKinematics([20., 150.])])
+
+
+def test_run_stores_seed(tmp_path):
+    store = ResultStore.create(str(tmp_path / 'run'))
+    results = make_sim().run(n_events=1000, store=store)[0]
+    seed = ResultStore.open(str(tmp_path / 'run')).seed
+    assert seed is not None
+    # the stored seed reproduces the run
+    rerun = make_sim().run(n_events=1000, seed=seed)[0]
+    assert results.equals(rerun)
+
+
+def test_run_stores_seed_of_generator(tmp_path):
+    store = ResultStore.create(str(tmp_path / 'run'))
+    esim = make_sim()
+    esim.run(n_events=100, rng=np.random.default_rng(7), store=store)
+    assert esim.seed == 7
+    assert ResultStore.open(str(tmp_path / 'run')).seed == 7
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import numpy as np
+
+from eloss import ede
+
+
+SRIM_FILE = os.path.join(ede.DEFAULT_STOPPING_POWERS_DATA_DIR,
+                         'Hydrogen in NaI.txt')
+
+
+def copy_srim_file(tmp_path):
+    path = str(tmp_path / 'Hydrogen in NaI.txt')
+    shutil.copy(SRIM_FILE, path)
+    return path
+
+
+def test_cache_replaces_stale_entries(tmp_path):
+    srim_file = copy_srim_file(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    first = ede.load_srim_stopping_power(srim_file, cache_dir)
+    os.utime(srim_file, (0, 0))
+    second = ede.load_srim_stopping_power(srim_file, cache_dir)
+    assert first.equals(second)
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_missing_cache_entry_is_parsed(tmp_path, monkeypatch):
+    srim_file = copy_srim_file(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    expected = ede.load_srim_stopping_power(srim_file, cache_dir)
+
+    # entry removed between the check and the load
+    def load(*args, **kwargs):
+        raise IOError('No such file')
+    monkeypatch.setattr(np, 'load', load)
+    assert ede.load_srim_stopping_power(srim_file, cache_dir).equals(expected)
@@ -7,15 +7,21 @@ import pandas as pd
 from scipy import integrate
 from scipy import constants
 
-from nmran.analyse import fft, zeropad, phase_correct, \
+from nmran.analyse import fft, phase_correct, \
     weight_signal, auto_phase_correct
 from nmran.dataio import load
 from nmran.datavis import data_viewer
 from nmran import common
+from nmran import batch
 
 
 FID_EXP_WEIGHTING = 15.
 
+# FID samples before this time in us and spectra frequencies out of
+# +-this value in Hz are cut, these are labels of DataFrame indices
+FID_CUT_TIME = 1400
+FFT_CUT_FREQ = 350e3
+
 # this one assumes that samples with equal amount of protons
 N_RATIO = 1.
 
@@ -102,17 +108,18 @@ def process_fid(fid):
 
 
 def do_fft(fid):
-    fid_zp = zeropad(fid)
-    ft_x, ft_y = fft(fid_zp['fid'], fid.index[1] - fid.index[0])
+    # zero padding is done by the transform
+    ft_x, ft_y = fft(fid['fid'], fid.index[1] - fid.index[0],
+                     n=common.fft_length(len(fid)))
     return pd.DataFrame(ft_y, index=ft_x, columns=['fft'])
 
 
 def cut_fid(fid):
-    return fid[1400:]
+    return fid.loc[FID_CUT_TIME:]
 
 
 def cut_fft(fft):
-    return fft[-350e3:350e3]
+    return fft.loc[-FFT_CUT_FREQ:FFT_CUT_FREQ]
 
 
 def compute_abs_pol(pol, target_irradiation_factor):
@@ -152,29 +159,16 @@ def compute_water_pol(water_fid):
 def compute_water_fft(water_fid):
     ft = cut_fft(do_fft(water_fid))
     pc_angle, ft['fft'] = auto_phase_correct(
-        ft['fft'], ft.index, step=1.)
+        ft['fft'], ft.index, step=1., method='analytic')
     return ft
 
 
 def compute_pol(data_dir, fids, flip_angle=None, pc=False, weighting=False):
-    values = []
-    time = []
-    for ds in fids:
-        fid_filepath = os.path.join(data_dir, ds['data'])
-        fid = cut_fid(load(fid_filepath))
-        if weighting:
-            fid['fid'] = weight_signal(fid.index, fid['fid'],
-                                       lb=FID_EXP_WEIGHTING)
-        ft = cut_fft(do_fft(fid))
-        if pc:
-            ft['fft'] = auto_phase_correct(ft['fft'], ft.index,
-                                           step=1.)[1]
-        ft['fft'] = np.real(ft['fft'])
-        res = integrate.simps(ft['fft'], ft.index)
-        res *= 10 ** (-ds['gain'] / 20.)
-        res *= 1 / np.sin(np.radians(flip_angle))
-        values.append(res)
-        time.append(ds['t'])
+    values = batch.process(
+        data_dir, fids, FID_CUT_TIME, (-FFT_CUT_FREQ, FFT_CUT_FREQ),
+        flip_angle=flip_angle, pc=pc, pc_step=1.,
+        lb=FID_EXP_WEIGHTING if weighting else None)
+    time = [ds['t'] for ds in fids]
     return pd.DataFrame(values, columns=['P'], index=time)
 
     
@@ -192,7 +186,8 @@ def show_fts(fids, data_dir, data_viewer, prefix='',
         ft = cut_fft(do_fft(fid))
         if auto_pc:
             pc_angle, ft['fft'] = auto_phase_correct(
-                ft['fft'], ft.index, step=1.)
+                ft['fft'], ft.index, step=1.,
+                method='analytic')
         else:
             pc_angle = ds['pc']
             ft['fft'] = phase_correct(ft['fft'], angle=ds['pc'])
@@ -239,7 +234,7 @@ if __name__ == '__main__':
     dv.add_object(ft_cut, "FFT cut: " + os.path.basename(fid_file))
 
     theta, ft_phase_corrected = auto_phase_correct(
-        ft_cut['fft'], ft_cut.index, step=0.5)
+        ft_cut['fft'], ft_cut.index, step=0.5, method='analytic')
     integr = integrate.simps(np.imag(ft_phase_corrected),
                              ft_cut.index)
     df_pc = pd.DataFrame(ft_phase_corrected, index=ft_cut.index,
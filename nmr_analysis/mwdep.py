@@ -6,15 +6,21 @@ import numpy as np
 import pandas as pd
 from scipy import integrate
 
-from nmran.analyse import fft, zeropad, auto_phase_correct, \
+from nmran.analyse import fft, auto_phase_correct, \
     phase_correct, weight_signal, _compute_exp_window
 from nmran.dataio import load
 from nmran.datavis import data_viewer
 from nmran import common
+from nmran import batch
 
 
 FID_EXP_WEIGHTING = 15.
 
+# FID samples before this time in us and spectra frequencies out of
+# +-this value in Hz are cut, these are labels of DataFrame indices
+FID_CUT_TIME = 1400
+FFT_CUT_FREQ = 350e3
+
 
 data2014_dir = '/Users/serj/projects/polp_data/1220/'
 small_flip_angle2014 = 7.55
@@ -63,38 +69,26 @@ def process_fid(fid, absint=False):
 
 
 def do_fft(fid):
-    fid_zp = zeropad(fid)
-    ft_x, ft_y = fft(fid_zp['fid'], fid.index[1] - fid.index[0])
+    # zero padding is done by the transform
+    ft_x, ft_y = fft(fid['fid'], fid.index[1] - fid.index[0],
+                     n=common.fft_length(len(fid)))
     return pd.DataFrame(ft_y, index=ft_x, columns=['fft'])
 
 
 def cut_fid(fid):
-    return fid[1400:]
+    return fid.loc[FID_CUT_TIME:]
 
 
 def cut_fft(fft):
-    return fft[-350e3:350e3]
+    return fft.loc[-FFT_CUT_FREQ:FFT_CUT_FREQ]
 
 
 def compute_mwdep(fids, data_dir, pc=False, weighting=False):
-    values = []
-    arguments = []
-    res = 0.
-    for ds in fids:
-        fid_filepath = os.path.join(data_dir, ds['data'])
-        fid = cut_fid(load(fid_filepath))
-        if weighting:
-            fid['fid'] = weight_signal(fid.index, fid['fid'], lb=5)
-        ft = cut_fft(do_fft(fid))
-        if pc:
-            ft['fft'] = auto_phase_correct(ft['fft'], ft.index,
-                                           step=1.)[1]
-            res = integrate.simps(np.real(ft['fft']), ft.index)
-        else:
-            res = integrate.simps(np.abs(ft['fft']), ft.index)
-        res *= 10 ** (-ds['gain'] / 20.)
-        values.append(res)
-        arguments.append(np.sqrt(ds['P']))
+    # without phase correction magnitudes of spectra are integrated
+    values = batch.process(
+        data_dir, fids, FID_CUT_TIME, (-FFT_CUT_FREQ, FFT_CUT_FREQ),
+        pc=pc, pc_step=1., lb=5 if weighting else None, absint=not pc)
+    arguments = [np.sqrt(ds['P']) for ds in fids]
     return pd.DataFrame(values, columns=['Pol'], index=arguments)
 
 
@@ -111,7 +105,7 @@ def show_fts(fids, data_dir, data_viewer,
         ft = cut_fft(do_fft(fid))
         if pc:
             ft['fft'] = auto_phase_correct(ft['fft'], ft.index,
-                                           step=1.)[1]
+                                           step=1., method='analytic')[1]
         data_viewer.add_object(ft, '{}{} FT'.format(prefix, ds['data']))
 
 
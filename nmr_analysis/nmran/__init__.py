@@ -1,3 +1,3 @@
 
 
-__all__ = ['common', 'analyse', 'dataio', 'datavis']
+__all__ = ['common', 'analyse', 'dataio', 'datavis', 'batch']
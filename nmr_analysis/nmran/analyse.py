@@ -13,6 +13,7 @@ import logging
 from nmran import common
 from nmran import dataio
 from nmran import datavis
+from nmran.batch import phase_angles
 
 
 def show_dir_fft(path):
@@ -35,26 +36,49 @@ def show_dir(path):
     return dv
 
 
-def fft(fid, dwell=1e-6, header=0, footer=0):
-    """Returns complex valued FFT of input signal as DataFrame object.
+def fft(fid, dwell=1e-6, header=0, footer=0, n=None):
+    """Returns frequencies in Hz and complex valued FFT of input signal.
 
-    Frequencies in Hz are index of the returned DataFrame.
+    Args:
+      n (int): Length of the transform, signal is zero padded up to it
+        without copying, see common.fft_length(). Signal length if None.
     """
-    logging.debug('computing FFT of input signal of length: {}'
-                  .format(len(fid)))
-    fft_output = np.fft.fft(fid)
+    if n is None:
+        n = len(fid)
+    logging.debug('computing FFT of input signal of length: {} (n={})'
+                  .format(len(fid), n))
+    fft_output = np.fft.fft(fid, n)
     fft_output = np.fft.fftshift(fft_output)
-    fft_freqs = np.fft.fftfreq(len(fid), dwell * 1e-6)
-    fft_freqs = np.fft.fftshift(fft_freqs)
-    return (fft_freqs, fft_output)
+    return (common.fft_freqs(n, dwell), fft_output)
+
 
+def auto_phase_correct(input_signal, signal_args, step=5, method='scan'):
+    """Phase corrects signal to have the smallest dispersive integral
+    with a positive absorptive one.
 
-def auto_phase_correct(input_signal, signal_args, step=5):
+    Args:
+      step (float): Angle step in deg. For the analytic method angles are
+        refined to this grid, None gives exact angles.
+      method (str): 'scan' tries all angles of the grid, 'analytic'
+        computes the angle from integrals of real & imaginary parts, see
+        batch.phase_angles().
+    Returns:
+      Tuple (angle in deg., phase corrected signal).
+    """
     logging.debug('searching phase correction angle:')
     logging.debug('\t - on an input signal of length: {}'
                   .format(len(input_signal)))
     logging.debug('\t - with angle step: {}'.format(step))
     assert(len(input_signal) == len(signal_args))
+    if method == 'analytic':
+        theta = phase_angles(
+            integrate.simps(np.real(input_signal), signal_args),
+            integrate.simps(np.imag(input_signal), signal_args), step)[0]
+        logging.debug('computed angle: {}'.format(theta))
+        return (theta, phase_correct(input_signal, angle=theta))
+    elif method != 'scan':
+        raise ValueError('Unknown phase correction method: "{}"'
+                         .format(method))
     res = []
     theta = 0
     while theta <= 360:
@@ -116,6 +140,8 @@ def zeropad(fid, zeros_num=None):
         If this argument is None, then it will be 3 * len(fid).
     Returns:
       New DataFrame object with padded zeros.
+
+    To pad for FFT pass the length to fft() instead, it does not copy.
     """
     if len(fid) < 2:
         raise(ValueError(('Invalid input FID signal: {}. '
@@ -123,13 +149,11 @@ def zeropad(fid, zeros_num=None):
                          .format(fid)))
     if zeros_num is None:
         zeros_num = len(fid) * 3
-    idx = []
     max_idx = len(fid) - 1
     dwell = fid.index[1] - fid.index[0]
-    for i in range(zeros_num):
-        idx.append(max_idx + (i + 1) * dwell)
+    idx = max_idx + np.arange(1, zeros_num + 1) * dwell
     df = pd.DataFrame(0, index=idx, columns=fid.columns)
-    return fid.append(df)
+    return pd.concat([fid, df])
 
 
 def _configure_logging():
@@ -0,0 +1,210 @@
+"""
+Batched processing of series of FID signals.
+
+FIDs of a series (build-up, MW dependence, ...) of equal length are
+stacked into one 2D complex array, one FID per row. Per-FID factors (gain,
+flip angle) and the window are applied by broadcasting, FFT runs along
+rows and all spectra are integrated in one call, instead of running the
+pandas pipeline file by file.
+
+Cut limits are labels of the data index like in slicing of the loaded
+DataFrames: FID times in us and spectrum frequencies in Hz.
+"""
+
+import os
+import logging
+
+import numpy as np
+from scipy import integrate
+
+from nmran import common
+from nmran import dataio
+
+
+def load_series(data_dir, fids):
+    """Loads FIDs of a series into one array.
+
+    Args:
+      data_dir (str): Directory with data files.
+      fids (list): Dicts describing FIDs, 'data' is the file name.
+    Returns:
+      Tuple (times in us, 2D complex array with one FID per row).
+    """
+    dfs = [dataio.load(os.path.join(data_dir, ds['data'])) for ds in fids]
+    return stack(dfs)
+
+
+def stack(dfs):
+    """Stacks loaded FID DataFrames of equal length & time axis."""
+    times = dfs[0].index.values
+    for df in dfs[1:]:
+        if len(df) != len(times) or \
+           not np.allclose(df.index.values, times):
+            raise ValueError('FIDs of a series should have equal length '
+                             'and dwell time, got lengths {} and {}'
+                             .format(len(times), len(df)))
+    return times, np.vstack([df['fid'].values for df in dfs])
+
+
+def cut(times, data, t_min):
+    """Drops samples of FIDs recorded before t_min us."""
+    keep = times >= t_min
+    return times[keep], data[:, keep]
+
+
+def exp_window(n, lb=1.0):
+    """Exponential window of analyse.weight_signal() for FIDs of length n."""
+    return np.exp(- lb * np.arange(1, n + 1) / float(n))
+
+
+def gain_factors(fids):
+    """Returns electronic gain factors 10^(-gain/20) of FIDs."""
+    return 10 ** (- np.array([ds['gain'] for ds in fids]) / 20.)
+
+
+def fft(times, data, zeros_num=None):
+    """Returns (frequencies in Hz, spectra) of FIDs in rows of data.
+
+    FIDs are zero padded by the transform with at least zeros_num zeros,
+    3 * FID length by default, up to the next fast FFT length.
+    """
+    n = data.shape[1]
+    if n < 2:
+        raise ValueError('Input FIDs should have at least 2 samples, '
+                         'got: {}'.format(n))
+    n_fft = common.fft_length(n, zeros_num)
+    dwell = times[1] - times[0]
+    logging.debug('computing FFT of {} signals of length: {}'
+                  .format(data.shape[0], n_fft))
+    spectra = np.fft.fftshift(np.fft.fft(data, n_fft, axis=1), axes=1)
+    return common.fft_freqs(n_fft, dwell), spectra
+
+
+def cut_spectra(freqs, spectra, f_min, f_max):
+    """Keeps frequencies in [f_min, f_max] Hz."""
+    keep = (freqs >= f_min) & (freqs <= f_max)
+    return freqs[keep], spectra[:, keep]
+
+
+def _corrected_integrals(re_int, im_int, thetas):
+    """Absorptive & dispersive integrals of spectra phase corrected by
+    thetas (deg.), rows of thetas are angles of each spectrum."""
+    a = np.radians(thetas)
+    abs_int = re_int[:, None] * np.cos(a) + im_int[:, None] * np.sin(a)
+    disp_int = -re_int[:, None] * np.sin(a) + im_int[:, None] * np.cos(a)
+    return abs_int, disp_int
+
+
+def _select_angle(abs_int, disp_int):
+    """Index of the first angle with the smallest dispersive part and
+    positive absorptive part in each row."""
+    return np.argmin(np.where(abs_int > 0, np.abs(disp_int), np.inf), axis=1)
+
+
+def scan_angles(step):
+    """Angles in deg. of the scan of analyse.auto_phase_correct(), from 0
+    by step up to 360 inclusive."""
+    return np.arange(int(np.floor(360. / step + 1e-9)) + 1) * step
+
+
+def phase_angles(re_int, im_int, step=None):
+    """Phase correction angles from integrals of real & imaginary parts.
+
+    Absorptive & dispersive integrals are R cos(theta - theta0) and
+    -R sin(theta - theta0) with theta0 = atan2(im_int, re_int), so the
+    dispersive part vanishes with a positive absorptive one at theta0.
+    If step is given the angle is refined to the scan grid of
+    analyse.auto_phase_correct(): grid angles around theta0 are compared
+    with the scan criterion, which gives the scan result.
+
+    Args:
+      re_int, im_int (array): Integrals of real & imaginary parts.
+      step (float): Step of the angle grid in deg., None for exact angles.
+    Returns:
+      Array of angles in deg. in [0, 360].
+    """
+    re_int = np.atleast_1d(np.asarray(re_int, dtype=float))
+    im_int = np.atleast_1d(np.asarray(im_int, dtype=float))
+    theta0 = np.degrees(np.arctan2(im_int, re_int)) % 360.
+    if step is None:
+        return theta0
+    k_max = len(scan_angles(step)) - 1
+    k = np.floor(theta0 / step)
+    # grid neighbours plus both ends of the grid, 0 is the upper neighbour
+    # of angles after the last grid angle
+    candidates = np.sort(np.clip(np.stack(
+        [k, k + 1, np.zeros_like(k), np.full_like(k, k_max)], axis=1),
+        0, k_max), axis=1)
+    thetas = candidates * step
+    idx = _select_angle(*_corrected_integrals(re_int, im_int, thetas))
+    return thetas[np.arange(len(idx)), idx]
+
+
+def auto_phase_angles(freqs, spectra, step=5, method='scan'):
+    """Phase correction angles of analyse.auto_phase_correct() of spectra.
+
+    Phase correction is linear, so integrals of corrected spectra are
+    combinations of integrals of their real & imaginary parts, both
+    methods need two integrations per spectrum.
+
+    Args:
+      step (float): Angle step in deg., for the analytic method None
+        gives exact angles.
+      method (str): 'scan' evaluates all angles of the grid,
+        'analytic' computes angles by phase_angles().
+    Returns:
+      Tuple (angles in deg., real parts integrals of corrected spectra).
+    """
+    re_int = integrate.simps(np.real(spectra), freqs, axis=1)
+    im_int = integrate.simps(np.imag(spectra), freqs, axis=1)
+    if method == 'scan':
+        thetas = scan_angles(step)[None, :]
+        abs_int, disp_int = _corrected_integrals(re_int, im_int, thetas)
+        idx = _select_angle(abs_int, disp_int)
+        return thetas[0, idx], abs_int[np.arange(len(idx)), idx]
+    elif method == 'analytic':
+        thetas = phase_angles(re_int, im_int, step)
+        abs_int = _corrected_integrals(re_int, im_int, thetas[:, None])[0]
+        return thetas, abs_int[:, 0]
+    raise ValueError('Unknown phase correction method: "{}"'.format(method))
+
+
+def integrate_spectra(freqs, spectra, absint=False):
+    """Integrates real parts (or magnitudes if absint) of all spectra."""
+    values = np.abs(spectra) if absint else np.real(spectra)
+    return integrate.simps(values, freqs, axis=1)
+
+
+def process(data_dir, fids, t_min, f_window, flip_angle=None, pc=False,
+            pc_step=1., pc_method='analytic', lb=None, absint=False):
+    """Computes integrals of spectra of a series of FIDs.
+
+    Args:
+      data_dir (str): Directory with data files.
+      fids (list): Dicts describing FIDs with 'data' & 'gain' keys.
+      t_min (float): FID samples before it (in us) are dropped.
+      f_window (tuple): (min, max) frequencies in Hz to integrate.
+      flip_angle (float): If given, integrals are divided by its sine.
+      pc (bool): Whether to phase correct spectra, see
+        auto_phase_angles().
+      pc_step (float): Angle step of the phase correction scan.
+      pc_method (str): Phase correction method, 'analytic' gives the
+        same angles as 'scan' on the grid of pc_step.
+      lb (float): If given, FIDs are weighted by exp_window().
+      absint (bool): Integrate magnitudes of spectra, used without pc.
+    Returns:
+      Array of integrals, one per FID.
+    """
+    times, data = cut(*load_series(data_dir, fids), t_min=t_min)
+    factors = gain_factors(fids)
+    if flip_angle is not None:
+        factors = factors / np.sin(np.radians(flip_angle))
+    data = data * factors[:, None]
+    if lb is not None:
+        data *= exp_window(data.shape[1], lb)[None, :]
+    freqs, spectra = cut_spectra(*fft(times, data), f_min=f_window[0],
+                                 f_max=f_window[1])
+    if pc:
+        return auto_phase_angles(freqs, spectra, step=pc_step,
+                                 method=pc_method)[1]
+    return integrate_spectra(freqs, spectra, absint=absint)
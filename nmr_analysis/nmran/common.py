@@ -3,7 +3,35 @@
 import os
 import logging
 
+import numpy as np
+from scipy import fftpack
+
+
+# (FFT length, dwell time) -> frequency axis of shifted FFT output
+_fft_freqs_cache = {}
+
 
 def configure_logging():
     program_path = os.path.dirname(os.path.realpath(__file__))
     logging.config.fileConfig(os.path.join(program_path, 'logging.cfg'))
+
+
+def fft_length(n, zeros_num=None, fast=True):
+    """Returns FFT length for a signal of n samples padded with zeros_num
+    zeros (3 * n by default), rounded up to the next fast FFT size."""
+    if zeros_num is None:
+        zeros_num = n * 3
+    if fast:
+        return fftpack.next_fast_len(n + zeros_num)
+    return n + zeros_num
+
+
+def fft_freqs(n, dwell):
+    """Returns cached frequencies in Hz of shifted FFT of length n,
+    dwell time is in us. Arrays are shared, so they are read-only."""
+    freqs = _fft_freqs_cache.get((n, dwell))
+    if freqs is None:
+        freqs = np.fft.fftshift(np.fft.fftfreq(n, dwell * 1e-6))
+        freqs.flags.writeable = False
+        _fft_freqs_cache[(n, dwell)] = freqs
+    return freqs
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# nmran is imported from the directory of the analysis scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from nmran import batch
+
+
+STEPS = [1., 5., 7., 11., 13., 0.7, 25.]
+
+
+def scan(re_int, im_int, step):
+    """Angle of the scan loop of analyse.auto_phase_correct() on
+    integrals of real & imaginary parts."""
+    best_theta, min_disp = None, np.inf
+    theta = 0
+    while theta <= 360:
+        a = np.radians(theta)
+        abs_int = re_int * np.cos(a) + im_int * np.sin(a)
+        disp_int = -re_int * np.sin(a) + im_int * np.cos(a)
+        if abs(disp_int) < min_disp and abs_int > 0:
+            best_theta, min_disp = theta, abs(disp_int)
+        theta += step
+    return best_theta
+
+
+@pytest.mark.parametrize('step', STEPS)
+def test_scan_angles_end_at_360(step):
+    thetas = batch.scan_angles(step)
+    assert thetas[0] == 0
+    assert thetas[-1] <= 360
+    assert thetas[-1] + step > 360
+
+
+@pytest.mark.parametrize('step', STEPS)
+def test_phase_angles_match_scan(step):
+    rng = np.random.RandomState(0)
+    # angles near multiples of the step & near 360 included
+    theta0 = np.concatenate([rng.uniform(0, 360, 300),
+                             360. - rng.uniform(0, step, 100)])
+    r = rng.uniform(0.5, 2., len(theta0))
+    re_int = r * np.cos(np.radians(theta0))
+    im_int = r * np.sin(np.radians(theta0))
+    thetas = batch.phase_angles(re_int, im_int, step)
+    expected = [scan(re, im, step) for re, im in zip(re_int, im_int)]
+    assert np.allclose(thetas, expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('step', STEPS)
+def test_auto_phase_angles_methods_agree(step):
+    rng = np.random.RandomState(1)
+    freqs = np.linspace(-1000., 1000., 201)
+    line = 1. / (1 + 1j * freqs / 100.)
+    phases = np.exp(1j * np.radians(rng.uniform(0, 360, 50)))
+    spectra = phases[:, None] * line[None, :]
+    scan_thetas, scan_ints = batch.auto_phase_angles(freqs, spectra, step,
+                                                     method='scan')
+    thetas, ints = batch.auto_phase_angles(freqs, spectra, step,
+                                           method='analytic')
+    assert np.all(scan_thetas <= 360)
+    assert np.allclose(thetas, scan_thetas)
+    assert np.allclose(ints, scan_ints)
+
+
+@pytest.mark.parametrize('step', [7., 11.])
+def test_phase_angles_match_auto_phase_correct(step):
+    analyse = pytest.importorskip('nmran.analyse')
+    rng = np.random.RandomState(2)
+    freqs = np.linspace(-1000., 1000., 201)
+    line = 1. / (1 + 1j * freqs / 100.)
+    for phase in np.concatenate([rng.uniform(0, 360, 20),
+                                 360. - rng.uniform(0, step, 10)]):
+        spectrum = np.exp(1j * np.radians(phase)) * line
+        theta = analyse.auto_phase_correct(spectrum, freqs, step)[0]
+        assert np.isclose(batch.auto_phase_angles(
+            freqs, spectrum[None, :], step, method='analytic')[0][0], theta)